@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Work done on worker threads: slow one-off jobs, like saving and loading
+# schemas, and the schema evaluation itself.
+# Results are polled from the frame timer, so they are always picked up on
+# the main thread.
+
+from collections import namedtuple
+import threading
+
+
+class Job(object):
+    # Runs `function(progress)` on a daemon thread, or, with thread=False,
+    # wherever run() is called. The function may call `progress` with the
+    # fraction of work done. Once `done` is set, either `result` or `error`
+    # holds the outcome, and whoever polls the job may pass the result on
+    # to `on_done`.
+
+    def __init__(self, name, function, on_done=None, thread=True):
+        self.name = name
+        self.function = function
+        self.on_done = on_done
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.done = False
+        self.thread = None
+        if thread:
+            self.thread = threading.Thread(target=self.run, name=name,
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self):
+        try:
+            self.result = self.function(self.set_progress)
+        except Exception as e:
+            self.error = e
+        self.done = True
+
+    def set_progress(self, fraction):
+        self.progress = fraction
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.done
+
+
+class Evaluator(object):
+    # Runs calculation steps on a worker thread, as beats of `clock` come.
+    #
+    # The worker holds `lock` while stepping, and the main thread holds it
+    # while changing the set of nodes and wires or the scheduler. After
+    # every batch of steps, `take_snapshot()` collects whatever the
+    # renderer shows, as a dict of immutable values keyed by node, and it
+    # is published as a new Snapshot. Renderer takes the current snapshot
+    # without locking and may keep it for as long as it wants; the next
+    # one is built aside and replaces it with a single assignment.
+    #
+    # Jobs that need the nodes in a consistent state can be queued to run
+    # on the worker, with the lock held, right after the next batch of
+    # steps. They delay the following step, so they should only take a
+    # quick copy of whatever they need.
+
+    Snapshot = namedtuple('Snapshot', ['step', 'contents'])
+
+    def __init__(self, clock, calculate, take_snapshot):
+        self.clock = clock
+        self.calculate = calculate
+        self.take_snapshot = take_snapshot
+        self.lock = threading.RLock()
+        self.snapshot = Evaluator.Snapshot(0, {})
+        self.requests = []
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='evaluator',
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopping.wait(self.clock.get_time_to_next_beat()):
+            n_steps = self.clock.poll()
+            if n_steps == 0:
+                continue
+
+            with self.lock:
+                for _ in range(n_steps):
+                    self.calculate()
+                self.snapshot = Evaluator.Snapshot(
+                    self.snapshot.step + n_steps, self.take_snapshot())
+                while self.requests:
+                    self.requests.pop(0).run()
+
+    def request(self, job):
+        # Queues a job made with thread=False.
+        self.requests.append(job)
+
+    def refresh(self, nodes=None):
+        # Updates the current snapshot after an edit, for the given nodes
+        # or for all of them, without waiting for the next step. Call with
+        # `lock` held.
+        if nodes is None:
+            contents = self.take_snapshot()
+        else:
+            contents = dict(self.snapshot.contents)
+            for node in nodes:
+                contents[node] = node.get_contents()
+        self.snapshot = Evaluator.Snapshot(self.snapshot.step, contents)
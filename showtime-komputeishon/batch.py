@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Evaluation of many instances of the same schema at once, with NumPy.
+#
+# Every wire and register holds a vector of `width` values, one per
+# instance, so a sweep over thousands of initial register values costs
+# about as much per step as a single run. Values are stored as three int64
+# arrays: a tag (None, int or Point) and two components. Unlike the scalar
+# engine, integers are limited to 64 bits.
+
+import numpy as np
+
+import engine
+
+NONE = 0
+INT = 1
+POINT = 2
+
+
+class Bank(object):
+    # Values of all node outputs, for every instance.
+    def __init__(self, n_slots, width):
+        self.tag = np.zeros((n_slots, width), dtype=np.int8)
+        self.x = np.zeros((n_slots, width), dtype=np.int64)
+        self.y = np.zeros((n_slots, width), dtype=np.int64)
+
+
+class BatchEngine(object):
+
+    COMPARISONS = {
+        '>': np.greater,
+        '<': np.less,
+        '=': np.equal,
+        '≠': np.not_equal,
+        '≥': np.greater_equal,
+        '≤': np.less_equal,
+    }
+
+    def __init__(self, nodes, wires, width, scheduler=None):
+        # Schema structure, operations and frozen flags are captured here;
+        # later edits of the nodes don't affect the batch.
+        if scheduler is None:
+            scheduler = engine.Scheduler()
+
+        self.width = width
+        self.steps = 0
+        groups = scheduler.get_groups(nodes, wires)
+        self.nodes = [node for group_nodes, _ in groups
+                      for node in group_nodes]
+
+        self.output_slot = {}
+        rank = {}
+        for group_idx, (group_nodes, _) in enumerate(groups):
+            for node in group_nodes:
+                rank[node] = group_idx
+                for idx in range(node.n_outputs):
+                    self.output_slot[(node, idx)] = len(self.output_slot)
+
+        # Same rule as in engine.Kernel: sources scheduled earlier on this
+        # step are read from the current bank, everything else from the
+        # previous one.
+        self.inputs = {}
+        for _, group_wires in groups:
+            for wire in group_wires:
+                src = wire.start.node
+                current = rank[src] < rank[wire.end.node]
+                slot = self.output_slot[(src, wire.start.idx)]
+                self.inputs[(wire.end.node, wire.end.idx)] = (current, slot)
+
+        n_slots = len(self.output_slot)
+        self.cur = Bank(n_slots, width)
+        self.prev = Bank(n_slots, width)
+        for (node, idx), slot in self.output_slot.items():
+            self._assign(self.prev, slot, self._constant(node.get_output(idx)))
+
+        self.registers = {}
+        self.pixels = {}
+        for node in self.nodes:
+            if isinstance(node, engine.RegisterNode):
+                self.registers[node] = self._constant(node.value)
+            elif isinstance(node, engine.GraphNode):
+                cells = np.frombuffer(node.pixels, dtype=np.uint8)
+                grid = np.zeros((width, node.nx, node.ny), dtype=bool)
+                grid[:] = cells.reshape(node.ny, node.nx).T != 0
+                self.pixels[node] = grid
+
+        self._none = self._constant(None)
+
+    def _constant(self, value):
+        tag = np.full(self.width, NONE, dtype=np.int8)
+        x = np.zeros(self.width, dtype=np.int64)
+        y = np.zeros(self.width, dtype=np.int64)
+        if type(value) == engine.Point:
+            tag[:] = POINT
+            x[:] = engine.force_int(value.x)
+            y[:] = engine.force_int(value.y)
+        elif value is not None:
+            tag[:] = INT
+            x[:] = engine.force_int(value)
+        return tag, x, y
+
+    @staticmethod
+    def _assign(bank, slot, value):
+        bank.tag[slot], bank.x[slot], bank.y[slot] = value
+
+    def set_register(self, node, values):
+        # Per-instance values of a register, as a sequence of integers.
+        values = np.asarray(values, dtype=np.int64)
+        tag = np.full(self.width, INT, dtype=np.int8)
+        x = np.broadcast_to(values, (self.width,)).copy()
+        self.registers[node] = (tag, x, np.zeros(self.width, dtype=np.int64))
+
+    def get_value(self, node, idx=0):
+        # Output of a node after the last step: values and a mask that is
+        # False where the output is None.
+        slot = self.output_slot[(node, idx)]
+        tag = self.prev.tag[slot]
+        if np.any(tag == POINT):
+            values = np.stack([self.prev.x[slot], self.prev.y[slot]], axis=-1)
+        else:
+            values = self.prev.x[slot].copy()
+        return values, tag != NONE
+
+    def get_register(self, node):
+        return self.registers[node][1].copy()
+
+    def get_pixels(self, node):
+        # Boolean array of shape (width, nx, ny).
+        return self.pixels[node]
+
+    def _input(self, node, idx):
+        if (node, idx) not in self.inputs:
+            return self._none
+        current, slot = self.inputs[(node, idx)]
+        bank = self.cur if current else self.prev
+        return bank.tag[slot], bank.x[slot], bank.y[slot]
+
+    @staticmethod
+    def _force_int(value):
+        tag, x, _ = value
+        return np.where(tag == INT, x, 0)
+
+    def _calculate_register(self, node):
+        tag, x, y = self.registers[node]
+        if not node.frozen:
+            in_tag, _, _ = in_value = self._input(node, 0)
+            latch = in_tag != NONE
+            x = np.where(latch, self._force_int(in_value), x)
+            tag = np.where(latch, INT, tag).astype(np.int8)
+            y = np.where(latch, 0, y)
+            self.registers[node] = (tag, x, y)
+
+        self._assign(self.cur, self.output_slot[(node, 0)], (tag, x, y))
+
+    def _calculate_arithmetic(self, node):
+        a_value = self._input(node, 0)
+        b_value = self._input(node, 1)
+        valid = (a_value[0] != NONE) & (b_value[0] != NONE)
+        a = self._force_int(a_value)
+        b = self._force_int(b_value)
+
+        op = node.operation
+        if op == '+':
+            result = a + b
+        elif op == '×':
+            result = a * b
+        elif op == '-':
+            result = a - b
+        elif op in ('/', '%'):
+            # Division by zero gives None, like in the scalar engine.
+            zero = b == 0
+            valid &= ~zero
+            safe_b = np.where(zero, 1, b)
+            result = a // safe_b if op == '/' else a % safe_b
+        else:
+            result = np.zeros(self.width, dtype=np.int64)
+            valid[:] = False
+
+        tag = np.where(valid, INT, NONE).astype(np.int8)
+        result = np.where(valid, result, 0)
+        self._assign(self.cur, self.output_slot[(node, 0)],
+                     (tag, result, np.zeros(self.width, dtype=np.int64)))
+
+    def _calculate_point(self, node):
+        slot = self.output_slot[(node, 0)]
+        if node.frozen:
+            self._assign(self.cur, slot, self._none)
+            return
+
+        a_value = self._input(node, 0)
+        b_value = self._input(node, 1)
+        valid = (a_value[0] != NONE) & (b_value[0] != NONE)
+        tag = np.where(valid, POINT, NONE).astype(np.int8)
+        self._assign(self.cur, slot,
+                     (tag, np.where(valid, self._force_int(a_value), 0),
+                      np.where(valid, self._force_int(b_value), 0)))
+
+    def _calculate_graph(self, node):
+        grid = self.pixels[node]
+        for idx in range(node.n_inputs):
+            if (node, idx) not in self.inputs:
+                continue
+            tag, x, y = self._input(node, idx)
+            hit = (tag == POINT) & (x >= 0) & (x < node.nx) & \
+                  (y >= 0) & (y < node.ny)
+            instances = np.nonzero(hit)[0]
+            grid[instances, x[instances], y[instances]] = True
+
+    def _calculate_conditional(self, node):
+        a_value = self._input(node, 0)
+        b_value = self._input(node, 1)
+        compare = self.COMPARISONS.get(node.operation)
+        holds = (a_value[0] != NONE) & (b_value[0] != NONE)
+        if compare is None:
+            holds[:] = False
+        else:
+            holds &= compare(self._force_int(a_value),
+                             self._force_int(b_value))
+
+        when_true = self._input(node, 2)
+        when_false = self._input(node, 3)
+        result = tuple(np.where(holds, t, f)
+                       for t, f in zip(when_true, when_false))
+        self._assign(self.cur, self.output_slot[(node, 0)], result)
+
+    def calculate(self):
+        for node in self.nodes:
+            if isinstance(node, engine.RegisterNode):
+                self._calculate_register(node)
+            elif isinstance(node, engine.ArithmeticNode):
+                self._calculate_arithmetic(node)
+            elif isinstance(node, engine.PointNode):
+                self._calculate_point(node)
+            elif isinstance(node, engine.GraphNode):
+                self._calculate_graph(node)
+            elif isinstance(node, engine.ConditionalNode):
+                self._calculate_conditional(node)
+            else:
+                raise Exception("can't batch {}".format(type(node)))
+
+        self.cur, self.prev = self.prev, self.cur
+        self.steps += 1
+
+    def run(self, n_steps):
+        for _ in range(n_steps):
+            self.calculate()
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Microbenchmarks for the evaluation engine, run on synthetic schemas.
+#
+#   python3 bench.py kernel --nodes 2000 --steps 100
+#   python3 bench.py batch --nodes 2000 --width 1000
+#   python3 bench.py shard --nodes 4000 --workers 1 2 4 8
+#   python3 bench.py hittest --nodes 10000
+#   python3 bench.py wires --wires 5000
+#   python3 bench.py memory --nodes 100000
+#   python3 bench.py edit --nodes 20000
+#   python3 bench.py schema --nodes 100000
+#   python3 bench.py clock --bpm 6000
+
+import argparse
+import math
+import random
+import sys
+import time
+
+import engine
+
+
+def build_schema(graph, n_nodes, seed=1):
+    # A few counters feeding a wide pipeline of arithmetic and conditional
+    # nodes, which ends in points plotted on graph nodes.
+    rnd = random.Random(seed)
+    outputs = []
+
+    one = graph.add_node(engine.RegisterNode)
+    one.value = 1
+    one.freeze(True)
+    outputs.append(one)
+
+    for k in range(max(1, n_nodes // 100)):
+        counter = graph.add_node(engine.RegisterNode)
+        counter.value = k
+        inc = graph.add_node(engine.ArithmeticNode)
+        inc.set_operation('+')
+        graph.add_wire(counter.get_terminal(engine.Node.OUTPUT, 0),
+                       inc.get_terminal(engine.Node.INPUT, 0))
+        graph.add_wire(one.get_terminal(engine.Node.OUTPUT, 0),
+                       inc.get_terminal(engine.Node.INPUT, 1))
+        graph.add_wire(inc.get_terminal(engine.Node.OUTPUT, 0),
+                       counter.get_terminal(engine.Node.INPUT, 0))
+        outputs.append(counter)
+
+    while len(graph.nodes) < n_nodes:
+        kind = rnd.random()
+        if kind < 0.7:
+            node = graph.add_node(engine.ArithmeticNode)
+            # No multiplication, values would grow without bound.
+            node.set_operation(rnd.choice('+-%/'))
+        elif kind < 0.85:
+            node = graph.add_node(engine.ConditionalNode)
+            node.set_operation(rnd.choice('<>=≠≥≤'))
+        elif kind < 0.95:
+            node = graph.add_node(engine.PointNode)
+        else:
+            node = graph.add_node(engine.GraphNode)
+
+        for idx in range(node.n_inputs):
+            source = rnd.choice(outputs[-50:])
+            graph.add_wire(source.get_terminal(engine.Node.OUTPUT, 0),
+                           node.get_terminal(engine.Node.INPUT, idx))
+
+        if node.n_outputs > 0:
+            outputs.append(node)
+
+
+def fingerprint(graph):
+    return [(node.value, node.get_output(0) if node.n_outputs else None,
+             len(getattr(node, 'plotted', ())))
+            for node in graph.nodes]
+
+
+def bench_kernel(args):
+    results = []
+    for title, setup in (
+            ('interpreted', lambda s: None),
+            ('incremental', lambda s: s.set_incremental(True)),
+            ('compiled', lambda s: s.set_compiled(True))):
+        graph = engine.GraphEngine()
+        build_schema(graph, args.nodes)
+        setup(graph.scheduler)
+
+        start = time.perf_counter()
+        graph.scheduler.calculate(graph.nodes, graph.wires)
+        prepare = time.perf_counter() - start
+
+        rate = graph.run(args.steps)
+        results.append((title, rate, fingerprint(graph)))
+        print('{:12} {:10.1f} steps/s  (first step {:.3f} s)'.format(
+              title, rate, prepare))
+
+    base = results[0][1]
+    for title, rate, state in results[1:]:
+        same = state == results[0][2]
+        print('{}: {:.2f}× faster than interpreted, results {}'.format(
+              title, rate / base, 'match' if same else 'DIFFER'))
+
+
+def bench_batch(args):
+    import batch
+
+    graph = engine.GraphEngine()
+    build_schema(graph, args.nodes)
+    start = time.perf_counter()
+    graph.run(args.steps)
+    scalar = time.perf_counter() - start
+    print('scalar: 1 instance, {:.3f} s'.format(scalar))
+
+    graph = engine.GraphEngine()
+    build_schema(graph, args.nodes)
+    registers = [node for node in graph.nodes
+                 if isinstance(node, engine.RegisterNode) and not node.frozen]
+    instances = batch.BatchEngine(graph.nodes, graph.wires, args.width)
+    for k, node in enumerate(registers):
+        instances.set_register(node, range(k, k + args.width))
+
+    start = time.perf_counter()
+    instances.run(args.steps)
+    vectorized = time.perf_counter() - start
+    print('batch: {} instances, {:.3f} s, {:.1f}× the cost of one, '
+          '{:.0f} instance-steps/s'.format(
+              args.width, vectorized, vectorized / scalar,
+              args.width * args.steps / vectorized))
+
+
+def bench_shard(args):
+    import shard
+
+    graph = engine.GraphEngine()
+    build_schema(graph, args.nodes)
+    start = time.perf_counter()
+    graph.run(args.steps)
+    single = time.perf_counter() - start
+    expected = fingerprint(graph)
+    pixels = [getattr(node, 'plotted', None) for node in graph.nodes]
+    print('single process: {:.3f} s'.format(single))
+
+    for n_workers in args.workers:
+        graph = engine.GraphEngine()
+        build_schema(graph, args.nodes)
+        sharded = shard.ShardedEngine(graph.nodes, graph.wires, n_workers)
+        try:
+            start = time.perf_counter()
+            sharded.run(args.steps)
+            elapsed = time.perf_counter() - start
+            sharded.collect()
+        finally:
+            sharded.close()
+
+        same = fingerprint(graph) == expected and \
+            [getattr(node, 'plotted', None) for node in graph.nodes] == pixels
+        print('{} worker{}: {:.3f} s, {:.2f}× speedup, {} boundary wires, '
+              'results {}'.format(
+                  n_workers, 's' if n_workers > 1 else '', elapsed,
+                  single / elapsed, sharded.n_boundary_wires,
+                  'match' if same else 'DIFFER'))
+
+
+def bench_hittest(args):
+    # Needs Gtk bindings installed, but not a display.
+    import main as gui
+    from spatial import GridIndex
+
+    rnd = random.Random(1)
+    size = int((args.nodes * 150 * 150) ** 0.5 * 2)
+    nodes = [gui.Node(n_inputs=rnd.randint(0, 4), n_outputs=rnd.randint(0, 2),
+                      x=rnd.uniform(0, size), y=rnd.uniform(0, size))
+             for _ in range(args.nodes)]
+    index = GridIndex()
+    for node in nodes:
+        index.insert(node, node.get_bounding_box())
+    events = [(rnd.uniform(0, size), rnd.uniform(0, size))
+              for _ in range(args.events)]
+
+    def linear(x, y):
+        for node in reversed(nodes):
+            res = node.get_intersections(x, y)
+            if res:
+                return res
+        return None
+
+    def indexed(x, y):
+        for node in index.query_point(x, y):
+            res = node.get_intersections(x, y)
+            if res:
+                return res
+        return None
+
+    results = []
+    runs = (('linear scan', linear, args.events // 10),
+            ('grid index', indexed, args.events))
+    for title, hit_test, n_events in runs:
+        start = time.perf_counter()
+        hits = [hit_test(x, y) for x, y in events[:n_events]]
+        elapsed = time.perf_counter() - start
+        results.append([None if h is None else (h.type, id(h.value.node)
+                        if h.type == gui.Node.TERMINAL else id(h.value))
+                        for h in hits])
+        print('{:12} {:10.0f} events/s'.format(title, n_events / elapsed))
+
+    same = results[0] == results[1][:len(results[0])]
+    print('results {}'.format('match' if same else 'DIFFER'))
+
+
+def bench_wires(args):
+    # Needs Gtk bindings installed, but not a display.
+    import cairo
+    import main as gui
+
+    rnd = random.Random(1)
+    width, height = 1920, 1080
+    phase = [0.0]
+    nodes = [gui.Node(x=rnd.uniform(0, width), y=rnd.uniform(0, height),
+                      phase_getter=lambda: phase[0])
+             for _ in range(max(2, args.wires // 4))]
+    for node in nodes:
+        node.freeze(args.frozen)
+    wires = [gui.Wire(start=rnd.choice(nodes).get_terminal(gui.Node.OUTPUT, 0),
+                      end=rnd.choice(nodes).get_terminal(gui.Node.INPUT, 0),
+                      phase_getter=lambda: phase[0])
+             for _ in range(args.wires)]
+
+    surface = cairo.ImageSurface(cairo.Format.RGB24, width, height)
+    layer = gui.WireLayer()
+    start = time.perf_counter()
+    for frame in range(args.frames):
+        phase[0] = frame / 60.0
+        layer.draw(cairo.Context(surface), wires)
+    elapsed = time.perf_counter() - start
+    print('{} wires, {} nodes: {:.1f} frames/s'.format(
+          args.wires, 'frozen' if args.frozen else 'animated',
+          args.frames / elapsed))
+
+
+def bench_memory(args):
+    import tracemalloc
+
+    import main as gui
+
+    def create_nodes(kinds):
+        rnd = random.Random(1)
+        return [rnd.choice(kinds)(x=rnd.uniform(0, 10000),
+                                  y=rnd.uniform(0, 10000))
+                for _ in range(args.nodes)]
+
+    rnd = random.Random(1)
+    kinds = [engine.ArithmeticNode] * 14 + [engine.ConditionalNode] * 3 + \
+        [engine.PointNode] * 2 + [engine.RegisterNode, engine.GraphNode]
+    gui_kinds = [gui.ArithmeticNode] * 14 + [gui.ConditionalNode] * 3 + \
+        [gui.PointNode] * 2 + [gui.RegisterNode, gui.GraphNode]
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    nodes = create_nodes(kinds)
+    nodes_size = tracemalloc.get_traced_memory()[0] - start
+
+    sources = [node for node in nodes if node.n_outputs > 0]
+    start = tracemalloc.get_traced_memory()[0]
+    wires = [engine.Wire(start=rnd.choice(sources).get_terminal(
+                             engine.Node.OUTPUT, 0),
+                         end=node.get_terminal(engine.Node.INPUT, idx))
+             for node in nodes for idx in range(node.n_inputs)]
+    wires_size = tracemalloc.get_traced_memory()[0] - start
+
+    # Canvas nodes, as the window creates them, on top of the engine state.
+    start = tracemalloc.get_traced_memory()[0]
+    gui_nodes = create_nodes(gui_kinds)
+    gui_nodes_size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    print('{} nodes: {:.1f} MiB, {:.0f} bytes per node'.format(
+          len(nodes), nodes_size / 2**20, nodes_size / len(nodes)))
+    print('{} wires: {:.1f} MiB, {:.0f} bytes per wire'.format(
+          len(wires), wires_size / 2**20, wires_size / len(wires)))
+    print('{} canvas nodes: {:.1f} MiB, {:.0f} bytes per node'.format(
+          len(gui_nodes), gui_nodes_size / 2**20,
+          gui_nodes_size / len(gui_nodes)))
+
+
+def bench_edit(args):
+    graph = engine.GraphEngine()
+    start = time.perf_counter()
+    build_schema(graph, args.nodes)
+    elapsed = time.perf_counter() - start
+    print('built {} nodes, {} wires: {:.3f} s'.format(
+          len(graph.nodes), len(graph.wires), elapsed))
+
+    victims = random.Random(1).sample(list(graph.nodes), len(graph.nodes) // 2)
+    start = time.perf_counter()
+    for node in victims:
+        graph.remove_node(node)
+    elapsed = time.perf_counter() - start
+    print('removed {} nodes: {:.3f} s, {:.1f} µs per node, {} wires left'
+          .format(len(victims), elapsed, 1e6 * elapsed / len(victims),
+                  len(graph.wires)))
+
+
+def bench_schema(args):
+    import os
+    import tempfile
+
+    import schema
+
+    graph = engine.GraphEngine()
+    build_schema(graph, args.nodes)
+    expected = fingerprint(graph)
+    print('{} nodes, {} wires'.format(len(graph.nodes), len(graph.wires)))
+
+    # Capture is what the evaluator does with the lock held.
+    start = time.perf_counter()
+    captured = schema.capture(graph.nodes, graph.wires)
+    print('capture: {:.3f} s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    nodes, wires = schema.make_records(*captured)
+    print('records: {:.3f} s'.format(time.perf_counter() - start))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for title, filename in (('json', 'state.json'),
+                                ('binary', 'state' + schema.BINARY_SUFFIX)):
+            path = os.path.join(tmp, filename)
+            start = time.perf_counter()
+            schema.save(path, nodes, wires)
+            save_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            schema.load(path)
+            load_time = time.perf_counter() - start
+
+            restored = engine.GraphEngine()
+            start = time.perf_counter()
+            restored.restore_state(path)
+            restore_time = time.perf_counter() - start
+
+            print('{:7} {:6.1f} MiB, save {:.3f} s, load {:.3f} s, '
+                  'restore {:.3f} s, schema {}'.format(
+                      title, os.path.getsize(path) / 2**20, save_time,
+                      load_time, restore_time,
+                      'matches' if fingerprint(restored) == expected
+                      else 'DIFFERS'))
+
+
+def simulate_clock(args, policy, own_timer):
+    # Runs a beat clock on simulated time. Frames start every 16 ms, or
+    # right after the previous one if it took longer, and every
+    # `spike_every` frame takes `spike` ms to render. With `own_timer`,
+    # beats have a timer of their own, which still has to wait for the frame
+    # being rendered; otherwise beats are only checked on frame ticks.
+    from timing import BeatClock
+
+    now = [0.0]
+    clock = BeatClock(args.bpm, policy, size=1000000, clock=lambda: now[0])
+    frame_interval = 0.016
+    next_frame = 0.0
+    busy_until = 0.0
+    n_frames = 0
+    while now[0] < args.duration:
+        next_beat = clock.get_beat_time(clock.next_beat)
+        if own_timer and next_beat < next_frame:
+            now[0] = max(busy_until, math.ceil(next_beat * 1000) / 1000)
+            busy_until = now[0] + clock.poll() * args.step / 1000
+            continue
+
+        now[0] = max(busy_until, next_frame)
+        if not own_timer:
+            now[0] += clock.poll() * args.step / 1000
+        n_frames += 1
+        frame_time = args.spike if n_frames % args.spike_every == 0 \
+            else args.frame
+        busy_until = now[0] + frame_time / 1000
+        next_frame = max(now[0] + frame_interval, busy_until)
+
+    return clock
+
+
+def bench_clock(args):
+    print('{} bpm, frames take {} ms, every {}th takes {} ms, steps take {} '
+          'ms'.format(args.bpm, args.frame, args.spike_every, args.spike,
+                      args.step))
+    for own_timer in (False, True):
+        for policy in ('all', 'coalesce', 'drop'):
+            clock = simulate_clock(args, policy, own_timer)
+            jitter = clock.get_jitter()
+            print('{:11} {:8} {:6} beats, {:6} steps, {:6} coalesced, {:6} '
+                  'dropped, late p50 {:5.1f} p99 {:5.1f} max {:5.1f} ms'
+                  .format('beat timer' if own_timer else 'frame tick',
+                          policy, clock.beats, clock.steps, clock.coalesced,
+                          clock.dropped, jitter['p50'], jitter['p99'],
+                          jitter['max']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Showtime Komputeishon microbenchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = subparsers.add_parser('kernel', help='interpreted vs compiled steps')
+    p.add_argument('--nodes', type=int, default=2000)
+    p.add_argument('--steps', type=int, default=100)
+    p.set_defaults(func=bench_kernel)
+
+    p = subparsers.add_parser('batch', help='NumPy batch vs single instance')
+    p.add_argument('--nodes', type=int, default=2000)
+    p.add_argument('--steps', type=int, default=100)
+    p.add_argument('--width', type=int, default=1000)
+    p.set_defaults(func=bench_batch)
+
+    p = subparsers.add_parser('shard', help='scaling across processes')
+    p.add_argument('--nodes', type=int, default=4000)
+    p.add_argument('--steps', type=int, default=200)
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    p.set_defaults(func=bench_shard)
+
+    p = subparsers.add_parser('hittest', help='pointer hit-testing')
+    p.add_argument('--nodes', type=int, default=10000)
+    p.add_argument('--events', type=int, default=10000)
+    p.set_defaults(func=bench_hittest)
+
+    p = subparsers.add_parser('wires', help='wire layer rendering')
+    p.add_argument('--wires', type=int, default=5000)
+    p.add_argument('--frames', type=int, default=100)
+    p.add_argument('--frozen', action='store_true')
+    p.set_defaults(func=bench_wires)
+
+    p = subparsers.add_parser('memory', help='memory used by a schema')
+    p.add_argument('--nodes', type=int, default=100000)
+    p.set_defaults(func=bench_memory)
+
+    p = subparsers.add_parser('edit', help='building and editing a schema')
+    p.add_argument('--nodes', type=int, default=20000)
+    p.set_defaults(func=bench_edit)
+
+    p = subparsers.add_parser('schema', help='saving and loading schemas')
+    p.add_argument('--nodes', type=int, default=100000)
+    p.set_defaults(func=bench_schema)
+
+    p = subparsers.add_parser('clock', help='beat timing under render load')
+    p.add_argument('--bpm', type=float, default=6000)
+    p.add_argument('--duration', type=float, default=60, help='seconds')
+    p.add_argument('--frame', type=float, default=4, help='ms')
+    p.add_argument('--spike', type=float, default=100, help='ms')
+    p.add_argument('--spike-every', type=int, default=50)
+    p.add_argument('--step', type=float, default=1, help='ms')
+    p.set_defaults(func=bench_clock)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
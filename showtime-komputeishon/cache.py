@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Least recently used cache with a size budget, which keeps pre-rendered
+# node sprites and text surfaces within a fixed amount of memory.
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    # Items are evicted, least recently used first, once their total size
+    # exceeds `capacity`. The size of a value is given by `size_of`; by
+    # default every value counts as one, so capacity is a number of items.
+
+    def __init__(self, capacity, size_of=lambda value: 1):
+        self.capacity = capacity
+        self.size_of = size_of
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key):
+        # Returns None if there is no such key.
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value):
+        if key in self.items:
+            self.size -= self.items.pop(key)[1]
+
+        size = self.size_of(value)
+        self.items[key] = (value, size)
+        self.size += size
+
+        # The newest item stays, even if it alone is over the budget.
+        while self.size > self.capacity and len(self.items) > 1:
+            _, (_, old_size) = self.items.popitem(last=False)
+            self.size -= old_size
+
+    def clear(self):
+        self.items = OrderedDict()
+        self.size = 0
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
@@ -0,0 +1,1079 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Headless part of Showtime Komputeishon: node semantics, wires and a batch
+# evaluation engine. Nothing here may import Gtk, cairo or Pango, so schemas
+# saved by the GUI can be run and benchmarked on machines without a display.
+
+from array import array
+from collections import namedtuple
+import argparse
+import json
+import sys
+import time
+
+Point = namedtuple('Point', ['x', 'y'])
+
+
+def force_int(value, base=10):
+    if type(value) == int:
+        return value
+
+    if type(value) == str:
+        return int(value, base)
+
+    return 0
+
+
+def none_row(n):
+    # Tuple of n Nones, for resetting fixed-size lists in place.
+    if n < len(NONE_ROWS):
+        return NONE_ROWS[n]
+    return (None,) * n
+
+
+NONE_ROWS = [(None,) * n for n in range(16)]
+
+
+def same_value(a, b):
+    # Stricter than ==, since for example force_int(True) differs from
+    # force_int(1), and GraphNode only accepts real Points.
+    return a is b or (type(a) == type(b) and a == b)
+
+
+class Terminal(object):
+    __slots__ = ('node', 'terminal_type', 'idx')
+
+    def __init__(self, node, terminal_type, idx):
+        self.node = node
+        self.terminal_type = terminal_type
+        self.idx = idx
+
+    def __eq__(self, other):
+        return self.node == other.node and \
+               self.terminal_type == other.terminal_type and \
+               self.idx == other.idx
+
+
+class Wire(object):
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start=None, end=None):
+        self.start = start
+        self.end = end
+
+
+def orient_wire(start, end):
+    # Returns (output, input) pair of terminals, or None if these two
+    # terminals can't be connected.
+    if start.node == end.node:
+        return None
+
+    wire_ends = (start.terminal_type, end.terminal_type)
+    if wire_ends == (Node.INPUT, Node.OUTPUT):
+        return end, start
+    elif wire_ends == (Node.OUTPUT, Node.INPUT):
+        return start, end  # Just what we wanted.
+
+    # Ignoring input-input and output-output wires.
+    return None
+
+
+class Node(object):
+
+    # Terminal type.
+    INPUT = 0
+    OUTPUT = 1
+
+    # Stateful nodes hold their value between steps, so wires coming into
+    # them don't form combinational paths.
+    STATEFUL = False
+
+    # Schemas may have hundreds of thousands of nodes, so nodes have no
+    # per-instance dictionary. Subclasses here declare their own slots too.
+    # State only some node types have, like the plot of a graph node, goes
+    # into `extra`, so that subclasses mixing these in with slots of their
+    # own still have compatible layouts.
+    __slots__ = ('n_inputs', 'n_outputs', 'frozen', 'x', 'y', 'value',
+                 'operation', 'input_values', 'output_values', 'terminals',
+                 'dirty', 'outputs_changed', 'on_edit', 'extra')
+
+    def __init__(self, n_inputs=1, n_outputs=1, x=0, y=0,
+                 on_edit=lambda _: None):
+        self.n_inputs = n_inputs
+        self.n_outputs = n_outputs
+        self.frozen = False
+        self.x = x
+        self.y = y
+        self.value = ''
+        self.operation = ''
+        self.input_values = [None] * n_inputs
+        self.output_values = [None] * n_outputs
+        self.terminals = None  # created on first use
+        self.dirty = True
+        self.outputs_changed = False
+        self.on_edit = on_edit
+        self.extra = None
+
+    def mark_edited(self):
+        # Node state was changed from outside, it needs to be recalculated
+        # even if its inputs stay the same.
+        self.dirty = True
+        self.on_edit(self)
+
+    def freeze(self, freeze):
+        self.frozen = bool(freeze)
+        self.mark_edited()
+
+    def _create_terminal(self, terminal_type, idx):
+        return Terminal(self, terminal_type, idx)
+
+    def get_terminal(self, terminal_type, idx):
+        # Terminals are created on first use and then reused, so nodes
+        # that are never wired or pointed at stay small.
+        n = self.n_inputs if terminal_type == Node.INPUT else self.n_outputs
+        if not 0 <= idx < n:
+            return self._create_terminal(terminal_type, idx)
+
+        if self.terminals is None:
+            self.terminals = ([None] * self.n_inputs, [None] * self.n_outputs)
+        terminals = self.terminals[terminal_type]
+        terminal = terminals[idx]
+        if terminal is None:
+            terminal = self._create_terminal(terminal_type, idx)
+            terminals[idx] = terminal
+        return terminal
+
+    def set_input(self, idx, value):
+        if not same_value(self.input_values[idx], value):
+            self.dirty = True
+        self.input_values[idx] = value
+
+    def set_output(self, idx, value):
+        if not same_value(self.output_values[idx], value):
+            self.outputs_changed = True
+        self.output_values[idx] = value
+
+    def get_input(self, idx):
+        if 0 <= idx < self.n_inputs:
+            return self.input_values[idx]
+        return None
+
+    def get_output(self, idx):
+        if 0 <= idx < self.n_outputs:
+            return self.output_values[idx]
+        return None
+
+    def reset_inputs(self):
+        self.input_values[:] = none_row(self.n_inputs)
+
+    def reset_outputs(self):
+        self.output_values[:] = none_row(self.n_outputs)
+
+    def calculate(self):
+        raise Exception("override this method")
+
+
+class RegisterNode(Node):
+    STATEFUL = True
+    __slots__ = ()
+
+    def __init__(self, value=0, **kwargs):
+        Node.__init__(self, n_inputs=1, n_outputs=1, **kwargs)
+        self.value = value
+
+    def calculate(self):
+        if not self.frozen:
+            input_0 = self.get_input(0)
+            if input_0 is not None:
+                self.value = force_int(input_0)
+
+        self.set_output(0, self.value)
+
+
+class ArithmeticNode(Node):
+    __slots__ = ()
+
+    def __init__(self, operation='+', **kwargs):
+        Node.__init__(self, n_inputs=2, n_outputs=1, **kwargs)
+        self.operation = operation
+        self.value = None
+
+    def set_operation(self, operation):
+        self.operation = operation
+        self.mark_edited()
+
+    def calculate(self):
+        input_0 = self.get_input(0)
+        input_1 = self.get_input(1)
+        if input_0 is not None and input_1 is not None:
+            input_0 = force_int(input_0)
+            input_1 = force_int(input_1)
+            if self.operation == '+':
+                self.value = input_0 + input_1
+            elif self.operation == '×':
+                self.value = input_0 * input_1
+            elif self.operation == '-':
+                self.value = input_0 - input_1
+            elif self.operation == '/':
+                self.value = None if input_1 == 0 else input_0 // input_1
+            elif self.operation == '%':
+                self.value = None if input_1 == 0 else input_0 % input_1
+            else:
+                self.value = None
+        else:
+            self.value = None
+
+        self.set_output(0, self.value)
+
+
+class PointNode(Node):
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        Node.__init__(self, n_inputs=2, n_outputs=1, **kwargs)
+        self.value = None
+        self.set_output(0, self.value)
+
+    def calculate(self):
+        if self.frozen:
+            return
+
+        input_0 = self.get_input(0)
+        input_1 = self.get_input(1)
+        if input_0 is not None and input_1 is not None:
+            self.value = Point(force_int(input_0), force_int(input_1))
+        else:
+            self.value = None
+
+        self.set_output(0, self.value)
+
+
+class Plot(object):
+    # Points plotted on a grid of nx×ny cells. `pixels` has a byte per cell,
+    # row by row from the bottom, and `plotted` lists indexes of cells in the
+    # order they were set, so whoever shows the plot can pick up new cells
+    # only. Both are replaced, not emptied, on clear. Points outside of the
+    # grid are dropped.
+    __slots__ = ('nx', 'ny', 'pixels', 'plotted')
+
+    def __init__(self, nx, ny):
+        self.nx = nx
+        self.ny = ny
+        self.clear()
+
+    def clear(self):
+        self.pixels = bytearray(self.nx * self.ny)
+        self.plotted = array('I')
+
+    def add(self, point):
+        x, y = point
+        if 0 <= x < self.nx and 0 <= y < self.ny:
+            k = y * self.nx + x
+            if not self.pixels[k]:
+                self.pixels[k] = 1
+                self.plotted.append(k)
+
+
+class GraphNode(Node):
+    # Plots on a grid of NX×NY cells unless given otherwise. The plot object
+    # stays the same for the life of the node.
+    NX = 40
+    NY = 40
+    __slots__ = ()
+
+    def __init__(self, nx=None, ny=None, **kwargs):
+        Node.__init__(self, n_inputs=8, n_outputs=0, **kwargs)
+        self._create_plot(nx or self.NX, ny or self.NY)
+
+    def _create_plot(self, nx, ny):
+        self.extra = Plot(nx, ny)
+
+    @property
+    def nx(self):
+        return self.extra.nx
+
+    @property
+    def ny(self):
+        return self.extra.ny
+
+    @property
+    def pixels(self):
+        return self.extra.pixels
+
+    @property
+    def plotted(self):
+        return self.extra.plotted
+
+    def plot(self, point):
+        self.extra.add(point)
+
+    def set_plotted(self, plotted):
+        # Replaces the plot with the given cells, in the order they were set.
+        plot = self.extra
+        plot.clear()
+        for k in plotted:
+            plot.pixels[k] = 1
+        plot.plotted.extend(plotted)
+
+    def get_points(self):
+        nx = self.extra.nx
+        return [Point(k % nx, k // nx) for k in self.extra.plotted]
+
+    def calculate(self):
+        for k in range(self.n_inputs):
+            input_val = self.get_input(k)
+            if type(input_val) == Point:
+                self.extra.add(input_val)
+
+    def clear(self):
+        self.extra.clear()
+        self.mark_edited()
+
+
+class ConditionalNode(Node):
+    __slots__ = ()
+
+    def __init__(self, operation='>', **kwargs):
+        Node.__init__(self, n_inputs=4, n_outputs=1, **kwargs)
+        self.operation = operation
+        self.value = None
+
+    def set_operation(self, operation):
+        self.operation = operation
+        self.mark_edited()
+
+    def calculate(self):
+        input_0 = self.get_input(0)
+        input_1 = self.get_input(1)
+        condition_holds = False
+        if input_0 is not None and input_1 is not None:
+            input_0 = force_int(input_0)
+            input_1 = force_int(input_1)
+
+            if self.operation == '>':
+                condition_holds = (input_0 > input_1)
+
+            elif self.operation == '<':
+                condition_holds = (input_0 < input_1)
+
+            elif self.operation == '=':
+                condition_holds = (input_0 == input_1)
+
+            elif self.operation == '≠':
+                condition_holds = (input_0 != input_1)
+
+            elif self.operation == '≥':
+                condition_holds = (input_0 >= input_1)
+
+            elif self.operation == '≤':
+                condition_holds = (input_0 <= input_1)
+
+        if condition_holds:
+            self.set_output(0, self.get_input(2))
+        else:
+            self.set_output(0, self.get_input(3))
+
+
+def strongly_connected_components(nodes, successors):
+    # Tarjan's algorithm, without recursion so that long chains don't hit
+    # the interpreter stack limit. Components come out in topological order.
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+
+    for root in nodes:
+        if root in index:
+            continue
+
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors[root]))]
+        while work:
+            node, it = work[-1]
+            for succ in it:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(successors[succ])))
+                    break
+                if succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+
+    components.reverse()
+    return components
+
+
+class Kernel(object):
+    # Whole evaluation step compiled into straight-line Python code. Node
+    # outputs live in two flat lists: the one being written on the current
+    # step, and the one holding results of the previous step. Register
+    # values are kept in a third list. Node types, operations and frozen
+    # flags are baked into the code, so changing them recompiles the chunk
+    # of code holding the node. Other edits only reload the node's state.
+
+    NODES_PER_CHUNK = 500
+
+    ARITHMETIC = {
+        '+': 'a + b',
+        '×': 'a * b',
+        '-': 'a - b',
+        '/': 'None if b == 0 else a // b',
+        '%': 'None if b == 0 else a % b',
+    }
+
+    CONDITIONS = {
+        '>': 'a > b',
+        '<': 'a < b',
+        '=': 'a == b',
+        '≠': 'a != b',
+        '≥': 'a >= b',
+        '≤': 'a <= b',
+    }
+
+    def __init__(self, groups):
+        self.nodes = [node for group_nodes, _ in groups
+                      for node in group_nodes]
+        self.output_slots = []
+        self.value_slots = []
+        output_slot = {}
+        value_slot = {}
+        rank = {}
+        for group_idx, (group_nodes, _) in enumerate(groups):
+            for node in group_nodes:
+                rank[node] = group_idx
+                for idx in range(node.n_outputs):
+                    output_slot[(node, idx)] = len(self.output_slots)
+                    self.output_slots.append((node, idx))
+                if isinstance(node, RegisterNode):
+                    value_slot[node] = len(self.value_slots)
+                    self.value_slots.append(node)
+
+        # Sources scheduled earlier on this step are read from the current
+        # list, everything else from the previous one.
+        self.inputs = {}
+        for _, group_wires in groups:
+            for wire in group_wires:
+                src = wire.start.node
+                list_name = 's' if rank[src] < rank[wire.end.node] else 'p'
+                slot = output_slot[(src, wire.start.idx)]
+                self.inputs[(wire.end.node, wire.end.idx)] = \
+                    '{}[{}]'.format(list_name, slot)
+
+        self.output_slot = output_slot
+        self.value_slot = value_slot
+        self.value_outputs = self._get_value_outputs()
+        self.positions = {node: k for k, node in enumerate(self.nodes)}
+        self.signatures = [self._get_signature(node) for node in self.nodes]
+
+        self.namespace = {'force_int': force_int, 'Point': Point}
+        for k, node in enumerate(self.nodes):
+            if isinstance(node, GraphNode):
+                self.namespace['g{}'.format(k)] = node.extra
+
+        n_chunks = max(1, -(-len(self.nodes) // self.NODES_PER_CHUNK))
+        self.sources = [None] * n_chunks
+        self.chunks = [self._compile_chunk(c) for c in range(n_chunks)]
+        self.load()
+
+    def _get_value_outputs(self):
+        # Nodes whose value is a copy of their output.
+        return [(node, self.output_slot[(node, 0)]) for node in self.nodes
+                if isinstance(node, ArithmeticNode) or
+                (isinstance(node, PointNode) and not node.frozen)]
+
+    @staticmethod
+    def _get_signature(node):
+        # Everything about the node that is baked into the code.
+        return (node.operation, node.frozen, getattr(node, 'nx', None),
+                getattr(node, 'ny', None))
+
+    def _input(self, node, idx):
+        return self.inputs.get((node, idx), 'None')
+
+    def _output(self, node, idx):
+        return 's[{}]'.format(self.output_slot[(node, idx)])
+
+    @staticmethod
+    def _coerce(name):
+        return 'if type({0}) is not int: {0} = fi({0})'.format(name)
+
+    def _emit_register(self, node, k):
+        value = 'r[{}]'.format(self.value_slot[node])
+        code = []
+        if not node.frozen and self._input(node, 0) != 'None':
+            code += ['a = ' + self._input(node, 0),
+                     'if a is not None:',
+                     '    ' + self._coerce('a'),
+                     '    {} = a'.format(value)]
+        code.append('{} = {}'.format(self._output(node, 0), value))
+        return code
+
+    def _emit_arithmetic(self, node, k):
+        out = self._output(node, 0)
+        a = self._input(node, 0)
+        b = self._input(node, 1)
+        if a == 'None' or b == 'None':
+            return [out + ' = None']
+
+        return ['a = ' + a,
+                'b = ' + b,
+                'if a is None or b is None:',
+                '    {} = None'.format(out),
+                'else:',
+                '    ' + self._coerce('a'),
+                '    ' + self._coerce('b'),
+                '    {} = {}'.format(out, self.ARITHMETIC.get(node.operation,
+                                                              'None'))]
+
+    def _emit_point(self, node, k):
+        out = self._output(node, 0)
+        a = self._input(node, 0)
+        b = self._input(node, 1)
+        if node.frozen or a == 'None' or b == 'None':
+            return [out + ' = None']
+
+        return ['a = ' + a,
+                'b = ' + b,
+                'if a is None or b is None:',
+                '    {} = None'.format(out),
+                'else:',
+                '    ' + self._coerce('a'),
+                '    ' + self._coerce('b'),
+                '    {} = Point(a, b)'.format(out)]
+
+    def _emit_graph(self, node, k):
+        code = []
+        for idx in range(node.n_inputs):
+            if self._input(node, idx) == 'None':
+                continue
+            # Cells already set are skipped without a call.
+            code += ['a = ' + self._input(node, idx),
+                     'if type(a) is Point:',
+                     '    x, y = a',
+                     '    if 0 <= x < {1} and 0 <= y < {2} and '
+                     'not g{0}.pixels[y * {1} + x]:'.format(k, node.nx,
+                                                            node.ny),
+                     '        g{}.add(a)'.format(k)]
+        return code
+
+    def _emit_conditional(self, node, k):
+        out = self._output(node, 0)
+        a = self._input(node, 0)
+        b = self._input(node, 1)
+        condition = self.CONDITIONS.get(node.operation)
+        if a == 'None' or b == 'None' or condition is None:
+            return ['{} = {}'.format(out, self._input(node, 3))]
+
+        return ['a = ' + a,
+                'b = ' + b,
+                'if a is not None and b is not None:',
+                '    ' + self._coerce('a'),
+                '    ' + self._coerce('b'),
+                '    {} = {} if {} else {}'.format(out, self._input(node, 2),
+                                                   condition,
+                                                   self._input(node, 3)),
+                'else:',
+                '    {} = {}'.format(out, self._input(node, 3))]
+
+    def _emit(self, node, k):
+        emitters = ((RegisterNode, self._emit_register),
+                    (ArithmeticNode, self._emit_arithmetic),
+                    (PointNode, self._emit_point),
+                    (GraphNode, self._emit_graph),
+                    (ConditionalNode, self._emit_conditional))
+        for node_class, emit in emitters:
+            if isinstance(node, node_class):
+                return ['# {}: {}{}'.format(
+                    k, type(node).__name__,
+                    ' ' + node.operation if node.operation else '')] + \
+                    emit(node, k)
+        raise Exception("can't compile {}".format(type(node)))
+
+    def _compile_chunk(self, c):
+        # Huge functions are slow to compile, so the step is split into
+        # several functions called one after another, each compiled on its
+        # own.
+        lines = ['def chunk_{}(s, p, r, fi=force_int, Point=Point,'
+                 ' type=type, int=int):'.format(c),
+                 '    pass']
+        first = c * self.NODES_PER_CHUNK
+        for k in range(first, min(first + self.NODES_PER_CHUNK,
+                                  len(self.nodes))):
+            lines += ['    ' + line for line in self._emit(self.nodes[k], k)]
+
+        self.sources[c] = '\n'.join(lines) + '\n'
+        exec(compile(self.sources[c], '<kernel chunk {}>'.format(c), 'exec'),
+             self.namespace)
+        return self.namespace['chunk_{}'.format(c)]
+
+    def node_edited(self, node):
+        # Returns False if the node isn't in the kernel, and the kernel has
+        # to be rebuilt.
+        k = self.positions.get(node)
+        if k is None:
+            return False
+
+        signature = self._get_signature(node)
+        if signature != self.signatures[k]:
+            self.signatures[k] = signature
+            c = k // self.NODES_PER_CHUNK
+            self.chunks[c] = self._compile_chunk(c)
+            self.value_outputs = self._get_value_outputs()
+        self.load_node(node)
+        return True
+
+    def load(self):
+        # Takes current state of the nodes, for example after a rebuild.
+        self.prev = [node.get_output(idx) for node, idx in self.output_slots]
+        self.cur = list(self.prev)
+        self.values = [node.value for node in self.value_slots]
+
+    def load_node(self, node):
+        # Same as load(), for a single node.
+        for idx in range(node.n_outputs):
+            slot = self.output_slot[(node, idx)]
+            self.prev[slot] = self.cur[slot] = node.get_output(idx)
+        slot = self.value_slot.get(node)
+        if slot is not None:
+            self.values[slot] = node.value
+
+    def step(self):
+        cur, prev, values = self.cur, self.prev, self.values
+        for chunk in self.chunks:
+            chunk(cur, prev, values)
+        self.cur, self.prev = prev, cur
+
+    def store(self):
+        # Writes results of the last step back into the nodes.
+        prev = self.prev
+        for (node, idx), value in zip(self.output_slots, prev):
+            node.output_values[idx] = value
+
+        for node, slot in self.value_outputs:
+            node.value = prev[slot]
+
+        for node, value in zip(self.value_slots, self.values):
+            node.value = value
+
+
+class Scheduler(object):
+
+    # Evaluation modes.
+    ONE_HOP = 0    # Values move one wire per step, in node list order.
+    PROPAGATE = 1  # Values run through a whole acyclic region in one step.
+
+    def __init__(self, mode=ONE_HOP, incremental=False, compiled=False):
+        self.mode = mode
+        self.incremental = incremental
+        self.compiled = compiled
+        self.groups = None
+        self.fanout = None
+        self.kernel = None
+        self.evaluated = 0
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.invalidate()
+
+    def set_incremental(self, incremental):
+        self.incremental = bool(incremental)
+        self.invalidate()
+
+    def set_compiled(self, compiled):
+        # Compiled evaluation takes precedence over incremental one.
+        self.compiled = bool(compiled)
+        self.invalidate()
+
+    def invalidate(self):
+        # Must be called after any change to the set of nodes or wires.
+        self.groups = None
+        self.kernel = None
+
+    def node_edited(self, node):
+        if self.kernel is not None and not self.kernel.node_edited(node):
+            self.kernel = None
+
+    def _build_groups(self, nodes, wires):
+        # A group is a list of nodes together with wires feeding them. All
+        # wires of a group are read before any of its nodes is calculated,
+        # so the group sees outputs of the nodes scheduled before it on the
+        # current step, and outputs of everything else from the previous one.
+        if self.mode == self.ONE_HOP:
+            return [(list(nodes), list(wires))]
+
+        incoming = {node: [] for node in nodes}
+        successors = {node: [] for node in nodes}
+        for wire in wires:
+            incoming[wire.end.node].append(wire)
+            if not wire.end.node.STATEFUL:
+                successors[wire.start.node].append(wire.end.node)
+
+        combinational = [node for node in nodes if not node.STATEFUL]
+        stateful = [node for node in nodes if node.STATEFUL]
+
+        # Nodes in a loop without a stateful node in it can't be ordered.
+        # They are evaluated together, one hop per step.
+        groups = []
+        for component in strongly_connected_components(combinational,
+                                                       successors):
+            group_wires = [w for node in component for w in incoming[node]]
+            groups.append((component, group_wires))
+
+        # Stateful nodes latch their inputs last, after everything they
+        # depend on was updated.
+        if stateful:
+            group_wires = [w for node in stateful for w in incoming[node]]
+            groups.append((stateful, group_wires))
+
+        return groups
+
+    def _build_fanout(self, wires):
+        # Wires leaving each node, along with the group index of their
+        # destination, for pushing changed values downstream.
+        rank = {}
+        for idx, (group_nodes, _) in enumerate(self.groups):
+            for node in group_nodes:
+                rank[node] = idx
+
+        fanout = {node: [] for node in rank}
+        for wire in wires:
+            fanout[wire.start.node].append((wire, rank[wire.end.node]))
+
+        return fanout
+
+    def _synchronize(self, wires):
+        # Bring inputs to the state the plain evaluation would see, and
+        # make every node recalculate once.
+        for group_nodes, _ in self.groups:
+            for node in group_nodes:
+                node.reset_inputs()
+                node.dirty = True
+
+        for wire in wires:
+            value = wire.start.node.get_output(wire.start.idx)
+            wire.end.node.set_input(wire.end.idx, value)
+
+    def get_groups(self, nodes, wires):
+        # Evaluation plan for the current mode, see _build_groups().
+        if self.groups is None:
+            self.groups = self._build_groups(nodes, wires)
+            self.fanout = None
+        return self.groups
+
+    def _prepare(self, nodes, wires):
+        self.get_groups(nodes, wires)
+        if self.incremental and not self.compiled and self.fanout is None:
+            self.fanout = self._build_fanout(wires)
+            self._synchronize(wires)
+
+        if self.compiled and self.kernel is None:
+            self.kernel = Kernel(self.groups)
+
+    def run(self, nodes, wires, n_steps):
+        # Same as calling calculate() n_steps times, but the compiled kernel
+        # only writes its results back into the nodes once, at the end.
+        if not self.compiled:
+            for _ in range(n_steps):
+                self.calculate(nodes, wires)
+            return
+
+        self._prepare(nodes, wires)
+        for _ in range(n_steps):
+            self.kernel.step()
+        self.kernel.store()
+        self.evaluated = len(nodes)
+
+    def calculate(self, nodes, wires):
+        self._prepare(nodes, wires)
+
+        if self.compiled:
+            self.kernel.step()
+            self.kernel.store()
+            self.evaluated = len(nodes)
+            return
+
+        if self.incremental:
+            self._calculate_incremental()
+            return
+
+        for group_nodes, group_wires in self.groups:
+            for wire in group_wires:
+                value = wire.start.node.get_output(wire.start.idx)
+                wire.end.node.set_input(wire.end.idx, value)
+
+            for node in group_nodes:
+                node.reset_outputs()
+                node.calculate()
+                node.reset_inputs()
+
+        self.evaluated = len(nodes)
+
+    def _calculate_incremental(self):
+        # Inputs are kept between steps and only updated by wires whose
+        # source output has changed. Nodes whose inputs didn't change are
+        # not recalculated, since that would give the same result.
+        fanout = self.fanout
+        evaluated = 0
+        previous = []  # outputs of the node being calculated, reused
+
+        # Deliver values that changed on the previous step or were set
+        # from outside, between steps.
+        for group_nodes, _ in self.groups:
+            for node in group_nodes:
+                if node.outputs_changed:
+                    node.outputs_changed = False
+                    for wire, _ in fanout[node]:
+                        value = node.get_output(wire.start.idx)
+                        wire.end.node.set_input(wire.end.idx, value)
+
+        for rank, (group_nodes, _) in enumerate(self.groups):
+            for node in group_nodes:
+                if not node.dirty:
+                    continue
+
+                # Same as reset_outputs() followed by calculate(), but
+                # keeps track of whether the outputs actually changed.
+                changed = node.outputs_changed
+                previous[:] = node.output_values
+                node.reset_outputs()
+                node.dirty = False
+                node.calculate()
+                for idx in range(node.n_outputs):
+                    if not same_value(previous[idx], node.output_values[idx]):
+                        changed = True
+                node.outputs_changed = changed
+                evaluated += 1
+
+            # Groups scheduled later on this step see new values right away.
+            # Everything else gets them at the beginning of the next step.
+            for node in group_nodes:
+                if not node.outputs_changed:
+                    continue
+                for wire, end_rank in fanout[node]:
+                    if end_rank > rank:
+                        value = node.get_output(wire.start.idx)
+                        wire.end.node.set_input(wire.end.idx, value)
+
+        self.evaluated = evaluated
+
+
+class Graph(object):
+    # Nodes and wires of a schema. Both are kept in dicts used as ordered
+    # sets, along with indexes of wires attached to each node and to each
+    # input terminal, so any edit costs time proportional to the number of
+    # wires it touches.
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.nodes = {}
+        self.wires = {}
+        self.node_wires = {}
+        self.input_wires = {}
+
+    def add_node(self, node):
+        self.nodes[node] = None
+        self.node_wires[node] = set()
+
+    def remove_node(self, node):
+        # Removes the node along with its wires.
+        for wire in list(self.node_wires[node]):
+            self.remove_wire(wire)
+        del self.node_wires[node]
+        del self.nodes[node]
+
+    def add_wire(self, wire):
+        # An input can only have one wire, the old one is replaced.
+        key = (wire.end.node, wire.end.idx)
+        old_wire = self.input_wires.get(key)
+        if old_wire is not None:
+            self.remove_wire(old_wire)
+
+        self.wires[wire] = None
+        self.input_wires[key] = wire
+        self.node_wires[wire.start.node].add(wire)
+        self.node_wires[wire.end.node].add(wire)
+
+    def remove_wire(self, wire):
+        del self.wires[wire]
+        del self.input_wires[(wire.end.node, wire.end.idx)]
+        self.node_wires[wire.start.node].discard(wire)
+        self.node_wires[wire.end.node].discard(wire)
+
+    def get_node_wires(self, node):
+        return self.node_wires[node]
+
+    def get_terminal_wires(self, terminal):
+        if terminal.terminal_type == Node.INPUT:
+            wire = self.input_wires.get((terminal.node, terminal.idx))
+            return [wire] if wire is not None else []
+
+        return [wire for wire in self.node_wires[terminal.node]
+                if wire.start == terminal]
+
+
+NODE_CLASSES = {node_class.__name__: node_class
+                for node_class in (RegisterNode, ArithmeticNode, PointNode,
+                                   GraphNode, ConditionalNode)}
+
+
+class GraphEngine(object):
+    def __init__(self):
+        self.graph = Graph()
+        self.steps = 0
+        self.scheduler = Scheduler()
+
+    @property
+    def nodes(self):
+        return self.graph.nodes
+
+    @property
+    def wires(self):
+        return self.graph.wires
+
+    def add_node(self, node_class, x=0, y=0):
+        node = node_class(x=x, y=y, on_edit=self.scheduler.node_edited)
+        self.graph.add_node(node)
+        self.scheduler.invalidate()
+        return node
+
+    def remove_node(self, node):
+        self.graph.remove_node(node)
+        self.scheduler.invalidate()
+
+    def add_wire(self, start, end):
+        terminals = orient_wire(start, end)
+        if terminals is None:
+            return
+
+        start, end = terminals
+        self.graph.add_wire(Wire(start=start, end=end))
+        self.scheduler.invalidate()
+
+    def restore_state(self, filename='state.json'):
+        # Takes schemas in both JSON and binary formats.
+        import schema
+
+        node_records, wire_records = schema.load(filename)
+        self.graph.clear()
+        self.scheduler.invalidate()
+
+        # Nodes of unknown types keep their place in the list, as None, so
+        # wire records still point at the right nodes.
+        nodes = []
+        for record in node_records:
+            node_class = NODE_CLASSES.get(record.type)
+            if node_class is not None:
+                obj = self.add_node(node_class, record.x, record.y)
+                obj.value = record.value
+                obj.frozen = record.frozen
+                obj.operation = record.operation
+            else:
+                obj = None
+            nodes.append(obj)
+
+        # Wire records are already oriented.
+        for record in wire_records:
+            start_node = nodes[record.start_node]
+            end_node = nodes[record.end_node]
+            if start_node is None or end_node is None:
+                continue
+            self.graph.add_wire(Wire(
+                start=start_node.get_terminal(Node.OUTPUT, record.start_idx),
+                end=end_node.get_terminal(Node.INPUT, record.end_idx)))
+
+    def save_state(self, filename='state.json'):
+        # Binary format is used for file names ending with .shtk.
+        import schema
+
+        schema.save(filename, *schema.snapshot(self.nodes, self.wires))
+
+    def calculate(self):
+        self.scheduler.calculate(self.nodes, self.wires)
+        self.steps += 1
+
+    def run(self, n_steps):
+        # Returns achieved evaluation rate, in steps per second.
+        start = time.perf_counter()
+        self.scheduler.run(self.nodes, self.wires, n_steps)
+        self.steps += n_steps
+        elapsed = time.perf_counter() - start
+
+        return n_steps / elapsed if elapsed > 0 else float('inf')
+
+    def get_pixels(self):
+        # Pixels of every GraphNode, keyed by node index in the schema.
+        return {idx: sorted(node.get_points())
+                for idx, node in enumerate(self.nodes)
+                if isinstance(node, GraphNode)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Run a saved Showtime schema without a display.')
+    parser.add_argument('state', nargs='?', default='state.json',
+                        help='schema saved by the GUI, in JSON or binary '
+                             'format (default: %(default)s)')
+    parser.add_argument('-n', '--steps', type=int, default=1000,
+                        help='evaluation steps to run (default: %(default)s)')
+    parser.add_argument('--pixels', metavar='FILE',
+                        help='dump GraphNode pixels as JSON ("-" for stdout)')
+    parser.add_argument('--propagate', action='store_true',
+                        help='propagate values through acyclic regions '
+                             'in a single step')
+    parser.add_argument('--incremental', action='store_true',
+                        help='recalculate only nodes with changed inputs')
+    parser.add_argument('--compiled', action='store_true',
+                        help='compile the schema into Python code first')
+    args = parser.parse_args(argv)
+
+    engine = GraphEngine()
+    if args.propagate:
+        engine.scheduler.set_mode(Scheduler.PROPAGATE)
+    if args.incremental:
+        engine.scheduler.set_incremental(True)
+    if args.compiled:
+        engine.scheduler.set_compiled(True)
+    engine.restore_state(args.state)
+    rate = engine.run(args.steps)
+
+    print('{} node{}, {} wire{}: {} steps, {:.1f} steps/s'.format(
+          len(engine.nodes), 's' if len(engine.nodes) > 0 else '',
+          len(engine.wires), 's' if len(engine.wires) > 0 else '',
+          args.steps, rate), file=sys.stderr)
+
+    if args.pixels is not None:
+        pixels = {str(idx): [list(p) for p in points]
+                  for idx, points in engine.get_pixels().items()}
+        text = json.dumps(pixels, indent=4)
+        if args.pixels == '-':
+            print(text)
+        else:
+            with open(args.pixels, 'w') as f:
+                f.write(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
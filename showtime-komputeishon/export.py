@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Offscreen rendering of a saved schema, no display needed. Beats are
+# simulated as fast as possible, and after each one, plots of graph nodes
+# and frames of the whole canvas, drawn the same way the window draws them,
+# are written to disk.
+#
+#   python3 export.py state.json --beats 100 --plots plots/
+#   python3 export.py state.shtk --beats 100 --frames frames/ --size 1280x720
+#   python3 export.py state.json --beats 100 --frames out/ --format raw
+#
+# Raw sequences go into a single file per output, frame after frame, named
+# after the frame size, e.g. frame-1280x720.bgra, which can be fed to
+#
+#   ffmpeg -f rawvideo -pixel_format bgra -video_size 1280x720 \
+#          -framerate 30 -i frame-1280x720.bgra out.mp4
+#
+# Plots are one byte per cell, 0 or 255, bottom row last (.gray).
+
+import argparse
+import os
+import sys
+import time
+
+import cairo
+
+import engine
+import schema
+from engine import Point
+from main import Color, GraphNode, Scene
+
+
+class Exporter(object):
+
+    BACKGROUND_COLOR = Color(1, 1, 1)
+    PLOT_SCALE = 8  # px per cell in PNG plots
+
+    def __init__(self, filename, scheduler=None):
+        self.scheduler = scheduler or engine.Scheduler()
+        self.phase = 0
+        self.scene = Scene()
+        node_records, wire_records = schema.load(filename)
+        for _ in self.scene.load(node_records, wire_records, self._create_node,
+                                 self._phase_func):
+            pass
+        self.beat = 0
+        self.raw_files = {}
+
+    def _create_node(self, node_class, x, y):
+        return node_class(phase_getter=self._phase_func, x=x, y=y)
+
+    def _phase_func(self):
+        return self.phase
+
+    def step(self):
+        self.scheduler.calculate(self.scene.nodes, self.scene.wires)
+        self.beat += 1
+
+    def take_snapshot(self):
+        return {node: node.get_contents() for node in self.scene.nodes}
+
+    def render_frame(self, contents, origin, width, height):
+        surface = cairo.ImageSurface(cairo.Format.ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        self.scene.draw(ctx, origin, width, height, contents)
+        surface.flush()
+        return surface
+
+    def render_plot(self, node, contents, scale):
+        # Cells become scale by scale squares, black on white.
+        plot = node.get_plot_surface(contents)
+        surface = cairo.ImageSurface(cairo.Format.RGB24, node.nx * scale,
+                                     node.ny * scale)
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(*self.BACKGROUND_COLOR)
+        ctx.paint()
+        ctx.scale(scale, scale)
+        pattern = cairo.SurfacePattern(plot)
+        pattern.set_filter(cairo.Filter.NEAREST)
+        ctx.set_source_rgb(0, 0, 0)
+        ctx.mask(pattern)
+        surface.flush()
+        return surface
+
+    def write(self, surface, directory, name, index, raw, suffix):
+        if not raw:
+            surface.write_to_png(os.path.join(
+                directory, '{}-{:06d}.png'.format(name, index)))
+            return
+
+        # Rows are written without the stride padding.
+        filename = os.path.join(directory, '{}-{}x{}.{}'.format(
+            name, surface.get_width(), surface.get_height(), suffix))
+        f = self.raw_files.get(filename)
+        if f is None:
+            f = open(filename, 'wb')
+            self.raw_files[filename] = f
+        data = surface.get_data()
+        stride = surface.get_stride()
+        row = surface.get_width() * (4 if suffix == 'bgra' else 1)
+        for k in range(surface.get_height()):
+            f.write(data[k * stride:k * stride + row])
+
+    def close(self):
+        for f in self.raw_files.values():
+            f.close()
+        self.raw_files = {}
+
+    def export_frames(self, contents, args):
+        # Phase runs on across beats, as the beat clock's does, since node
+        # tilt repeats only every two beats.
+        for k in range(args.frames_per_beat):
+            self.phase = (self.beat - 1) + k / args.frames_per_beat
+            surface = self.render_frame(contents, args.origin, *args.size)
+            self.write(surface, args.frames, 'frame',
+                       self.beat * args.frames_per_beat + k,
+                       args.format == 'raw', 'bgra')
+
+    def export_plots(self, contents, args):
+        graph_nodes = [node for node in self.scene.nodes
+                       if isinstance(node, GraphNode)]
+        for k, node in enumerate(graph_nodes):
+            if args.format == 'raw':
+                surface = node.get_plot_surface(contents[node])
+            else:
+                surface = self.render_plot(node, contents[node],
+                                           self.PLOT_SCALE)
+            self.write(surface, args.plots, 'plot{}'.format(k), self.beat,
+                       args.format == 'raw', 'gray')
+
+
+def parse_size(text):
+    width, height = text.split('x')
+    return int(width), int(height)
+
+
+def parse_origin(text):
+    x, y = text.split(',')
+    return Point(float(x), float(y))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Render a Showtime schema offscreen, beat by beat.')
+    parser.add_argument('input', help='schema in either format')
+    parser.add_argument('--beats', type=int, default=100)
+    parser.add_argument('--frames', metavar='DIR',
+                        help='write frames of the whole canvas here')
+    parser.add_argument('--plots', metavar='DIR',
+                        help='write plots of graph nodes here')
+    parser.add_argument('--format', choices=['png', 'raw'], default='png')
+    parser.add_argument('--size', type=parse_size, default=(1280, 720),
+                        metavar='WxH')
+    parser.add_argument('--origin', type=parse_origin, default=Point(0, 0),
+                        metavar='X,Y', help='canvas point at the top left')
+    parser.add_argument('--frames-per-beat', type=int, default=1,
+                        help='animation phases drawn for each beat')
+    parser.add_argument('--every', type=int, default=1,
+                        help='export every this many beats')
+    parser.add_argument('--propagate', action='store_true')
+    parser.add_argument('--compiled', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.frames is None and args.plots is None:
+        parser.error('nothing to export, use --frames or --plots')
+    for directory in (args.frames, args.plots):
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    scheduler = engine.Scheduler(
+        mode=engine.Scheduler.PROPAGATE if args.propagate
+        else engine.Scheduler.ONE_HOP,
+        compiled=args.compiled)
+    exporter = Exporter(args.input, scheduler)
+
+    start = time.perf_counter()
+    try:
+        for _ in range(args.beats):
+            exporter.step()
+            if exporter.beat % args.every != 0:
+                continue
+            contents = exporter.take_snapshot()
+            if args.frames is not None:
+                exporter.export_frames(contents, args)
+            if args.plots is not None:
+                exporter.export_plots(contents, args)
+    finally:
+        exporter.close()
+    elapsed = time.perf_counter() - start
+
+    print('{} beat{} in {:.2f} s, {:.1f} beats/s'.format(
+          args.beats, 's' if args.beats != 1 else '', elapsed,
+          args.beats / elapsed if elapsed > 0 else 0), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: MIT
 
 from collections import namedtuple
+from contextlib import nullcontext
 from datetime import datetime
 from pprint import pprint
 import cairo
@@ -10,7 +11,14 @@ import gi
 import math
 import time
 import sys
-import json
+
+import engine
+import schema
+from background import Evaluator, Job
+from cache import LRUCache
+from engine import Point, force_int
+from spatial import GridIndex, boxes_intersect
+from timing import BeatClock, FrameCounter, Profiler
 
 gi.require_version('Gtk', '3.0')
 gi.require_version('PangoCairo', '1.0')
@@ -18,47 +26,30 @@ from gi.repository import Gtk, Gdk, GLib, Pango, PangoCairo  # noqa: E402
 
 Color = namedtuple('Color', ['r', 'g', 'b'])
 ColorPair = namedtuple('ColorPair', ['foreground', 'background'])
-Point = namedtuple('Point', ['x', 'y'])
 
 main_window = None
 
 
-class Obj(object):
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
-
-
-class Terminal(object):
-    def __init__(self, node, terminal_type, idx, get_coords):
-        self.node = node
-        self.terminal_type = terminal_type
-        self.idx = idx
-        self.get_coords = get_coords
+def surface_size(surface):
+    return surface.get_stride() * surface.get_height()
 
-    def __eq__(self, other):
-        return self.node == other.node and \
-               self.terminal_type == other.terminal_type and \
-               self.idx == other.idx
 
+# Pre-rendered node bodies, shadows and texts, shared by all nodes.
+sprites = LRUCache(64 * 1024 * 1024, size_of=lambda s: surface_size(s.surface))
+text_surfaces = LRUCache(16 * 1024 * 1024, size_of=surface_size)
 
-def force_int(value, base=10):
-    if type(value) == int:
-        return value
 
-    if type(value) == str:
-        return int(value, base)
-
-    return 0
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
 
 
-def curve_position(t, x0, y0, x1, y1, x2, y2, x3, y3):
-    c0 = (1 - t) * (1 - t) * (1 - t)
-    c1 = 3 * t * (1 - t) * (1 - t)
-    c2 = 3 * t * t * (1 - t)
-    c3 = t * t * t
+class Terminal(engine.Terminal):
+    __slots__ = ()
 
-    return Point(c0 * x0 + c1 * x1 + c2 * x2 + c3 * x3,
-                 c0 * y0 + c1 * y1 + c2 * y2 + c3 * y3)
+    def get_coords(self):
+        return self.node._get_terminal_absolute_pos(self.terminal_type,
+                                                    self.idx)
 
 
 def draw_rounded_rectangle(ctx, x, y, w, h, r, top_tilt):
@@ -71,7 +62,14 @@ def draw_rounded_rectangle(ctx, x, y, w, h, r, top_tilt):
     ctx.close_path()
 
 
-class Wire(object):
+class Wire(engine.Wire):
+
+    __slots__ = ('phase', 'phase_getter', 'geometry')
+
+    # Control points of the curve, its bounding box and coefficients for
+    # finding points on it.
+    Geometry = namedtuple('Geometry', ['ends', 'points', 'bbox', 'x_coeffs',
+                                       'y_coeffs'])
 
     DOT_RADIUS = 10
     DOT_COLOR = Color(1, 0, 0)
@@ -80,10 +78,10 @@ class Wire(object):
     LINE_WIDTH = 3
 
     def __init__(self, start=None, end=None, phase_getter=lambda: 0):
-        self.start = start
-        self.end = end
+        engine.Wire.__init__(self, start=start, end=end)
         self.phase = 0
         self.phase_getter = phase_getter
+        self.geometry = None
         self._update_phase(first_time=True)
 
     @staticmethod
@@ -91,30 +89,6 @@ class Wire(object):
         diff = (end_pos.y - start_pos.y) / 100
         return Wire.CURVE_OFFSET * min(diff * diff, 1)
 
-    def _draw_dot(self, ctx, start_pos, end_pos, curve_offset):
-        self._update_phase()
-        t, _ = math.modf(self.phase)  # t is in [0..1]
-
-        cur_pos = curve_position(t, *start_pos,
-                                 start_pos.x + curve_offset, start_pos.y,
-                                 end_pos.x - curve_offset, end_pos.y,
-                                 *end_pos)
-
-        pattern = cairo.RadialGradient(*cur_pos, 0, *cur_pos, self.DOT_RADIUS)
-        pattern.add_color_stop_rgba(0, *self.DOT_COLOR, 1)
-        pattern.add_color_stop_rgba(1, *self.DOT_COLOR, 0)
-        ctx.set_source(pattern)
-        ctx.arc(*cur_pos, self.DOT_RADIUS, 0, 2 * math.pi)
-        ctx.fill()
-
-    def _draw_wire(self, ctx, start_pos, end_pos, curve_offset):
-        ctx.set_source_rgba(*Wire.LINE_COLOR)
-        ctx.set_line_width(Wire.LINE_WIDTH)
-        ctx.move_to(*start_pos)
-        ctx.curve_to(start_pos.x + curve_offset, start_pos.y,
-                     end_pos.x - curve_offset, end_pos.y, *end_pos)
-        ctx.stroke()
-
     @staticmethod
     def draw_wire(ctx, start_pos, end_pos):
         ctx.set_source_rgba(*Wire.LINE_COLOR)
@@ -123,34 +97,203 @@ class Wire(object):
         ctx.line_to(*end_pos)
         ctx.stroke()
 
-    def draw(self, ctx):
+    @staticmethod
+    def _bounding_box(start_pos, end_pos, curve_offset):
+        # The curve lies within the convex hull of its control points.
+        pad = max(Wire.DOT_RADIUS, Wire.LINE_WIDTH)
+        xs = (start_pos.x, start_pos.x + curve_offset,
+              end_pos.x - curve_offset, end_pos.x)
+        return (min(xs) - pad, min(start_pos.y, end_pos.y) - pad,
+                max(xs) + pad, max(start_pos.y, end_pos.y) + pad)
+
+    def get_geometry(self):
+        # Geometry is kept until one of the ends moves. Returns None for a
+        # wire that can't be drawn.
         if not self.start or not self.end:
-            return
+            return None
 
         start_pos = self.start.get_coords()
         end_pos = self.end.get_coords()
         if not start_pos or not end_pos:
-            return
+            return None
+
+        ends = (start_pos, end_pos)
+        if self.geometry is not None and self.geometry.ends == ends:
+            return self.geometry
 
         curve_offset = self._curve_offset(start_pos, end_pos)
-        self._draw_wire(ctx, start_pos, end_pos, curve_offset)
-        self._draw_dot(ctx, start_pos, end_pos, curve_offset)
+        x0, y0 = start_pos
+        x1, y1 = start_pos.x + curve_offset, start_pos.y
+        x2, y2 = end_pos.x - curve_offset, end_pos.y
+        x3, y3 = end_pos
+
+        # Power basis form of the Bézier curve: ((a t + b) t + c) t + d.
+        self.geometry = Wire.Geometry(
+            ends=ends,
+            points=(x0, y0, x1, y1, x2, y2, x3, y3),
+            bbox=self._bounding_box(start_pos, end_pos, curve_offset),
+            x_coeffs=(x3 - 3 * x2 + 3 * x1 - x0, 3 * x2 - 6 * x1 + 3 * x0,
+                      3 * x1 - 3 * x0, x0),
+            y_coeffs=(y3 - 3 * y2 + 3 * y1 - y0, 3 * y2 - 6 * y1 + 3 * y0,
+                      3 * y1 - 3 * y0, y0))
+        return self.geometry
+
+    def get_bounding_box(self):
+        geometry = self.get_geometry()
+        return geometry.bbox if geometry is not None else None
+
+    def get_dot_position(self, geometry):
+        self._update_phase()
+        t, _ = math.modf(self.phase)  # t is in [0..1]
+        a, b, c, d = geometry.x_coeffs
+        x = ((a * t + b) * t + c) * t + d
+        a, b, c, d = geometry.y_coeffs
+        y = ((a * t + b) * t + c) * t + d
+        return x, y
+
+    def is_animated(self):
+        # The dot stays still on wires between two frozen nodes.
+        if not self.start or not self.end:
+            return True
+        return not (self.start.node.frozen and self.end.node.frozen)
 
     def _update_phase(self, first_time=False):
-        phase = self.phase_getter()
+        phase = self.phase_getter() if self.is_animated() else 0
         self.phase = phase
 
 
-class Node(object):
+class WireLayer(object):
+    # Draws all wires at once: curves are stroked as a single path, and
+    # dots are copies of one pre-rendered sprite.
+
+    def __init__(self):
+        self.dot_sprite = None
+
+    def get_dot_sprite(self):
+        if self.dot_sprite is not None:
+            return self.dot_sprite
+
+        r = Wire.DOT_RADIUS
+        self.dot_sprite = cairo.ImageSurface(cairo.Format.ARGB32, 2 * r, 2 * r)
+        ctx = cairo.Context(self.dot_sprite)
+        pattern = cairo.RadialGradient(r, r, 0, r, r, r)
+        pattern.add_color_stop_rgba(0, *Wire.DOT_COLOR, 1)
+        pattern.add_color_stop_rgba(1, *Wire.DOT_COLOR, 0)
+        ctx.set_source(pattern)
+        ctx.arc(r, r, r, 0, 2 * math.pi)
+        ctx.fill()
+        return self.dot_sprite
+
+    def draw(self, ctx, wires, viewport=None):
+        # Returns the wires drawn. Those lying outside of the viewport are
+        # skipped.
+        visible = []
+        for wire in wires:
+            geometry = wire.get_geometry()
+            if geometry is None:
+                continue
+            if viewport is not None and \
+               not boxes_intersect(geometry.bbox, viewport):
+                continue
+            visible.append((wire, geometry))
+
+        ctx.set_source_rgb(*Wire.LINE_COLOR)
+        ctx.set_line_width(Wire.LINE_WIDTH)
+        for _, geometry in visible:
+            x0, y0, x1, y1, x2, y2, x3, y3 = geometry.points
+            ctx.move_to(x0, y0)
+            ctx.curve_to(x1, y1, x2, y2, x3, y3)
+        ctx.stroke()
+
+        sprite = self.get_dot_sprite()
+        r = Wire.DOT_RADIUS
+        for wire, geometry in visible:
+            x, y = wire.get_dot_position(geometry)
+            ctx.set_source_surface(sprite, x - r, y - r)
+            ctx.rectangle(x - r, y - r, 2 * r, 2 * r)
+            ctx.fill()
+
+        return [wire for wire, _ in visible]
+
+
+class FrozenLayer(object):
+    # Frozen nodes and wires between two of them don't animate, so they are
+    # composited once into a surface covering the visible part of the canvas
+    # and a margin around it, and then the surface is blitted every frame.
+    # The layer is rebuilt when one of its nodes, or a node at an end of
+    # one of its wires, is edited, moved or thawed, when a node gets frozen,
+    # when the visible part leaves the covered box, or when contents of a
+    # frozen node change anyway.
+
+    MARGIN = 256  # px
+
+    def __init__(self):
+        self.valid = False
+        self.surface = None  # None if the layer is empty
+        self.box = None
+        self.contents = {}  # frozen nodes in the layer, and their contents
+        self.wire_nodes = set()  # ends of wires in the layer
+        self.n_wires = 0
+
+    def invalidate(self):
+        self.valid = False
+
+    def node_changed(self, node):
+        # Ends of wires in the layer may lie outside of the box.
+        if node.frozen or node in self.contents or node in self.wire_nodes:
+            self.invalidate()
+
+    def wire_changed(self, wire):
+        if not wire.is_animated():
+            self.invalidate()
+
+    def covers(self, area, contents):
+        if not self.valid:
+            return False
+        x0, y0, x1, y1 = area
+        bx0, by0, bx1, by1 = self.box
+        if x0 < bx0 or y0 < by0 or x1 > bx1 or y1 > by1:
+            return False
+        for node, drawn in self.contents.items():
+            if contents.get(node) != drawn:
+                return False
+        return True
+
+    def render(self, area, contents, draw_function):
+        # draw_function(ctx, box, contents) draws in canvas coordinates and
+        # returns the nodes and the wires drawn.
+        x0, y0, x1, y1 = area
+        self.box = (math.floor(x0) - self.MARGIN, math.floor(y0) - self.MARGIN,
+                    math.ceil(x1) + self.MARGIN, math.ceil(y1) + self.MARGIN)
+        self.surface = cairo.ImageSurface(cairo.Format.ARGB32,
+                                          self.box[2] - self.box[0],
+                                          self.box[3] - self.box[1])
+        ctx = cairo.Context(self.surface)
+        ctx.translate(- self.box[0], - self.box[1])
+        nodes, wires = draw_function(ctx, self.box, contents)
+        self.contents = {node: contents.get(node) for node in nodes}
+        self.wire_nodes = {wire.start.node for wire in wires} | \
+            {wire.end.node for wire in wires}
+        self.n_wires = len(wires)
+        if not nodes and not wires:
+            self.surface = None
+        self.valid = True
+
+    def draw(self, ctx, viewport):
+        if self.surface is None:
+            return
+        x0, y0, x1, y1 = viewport
+        ctx.set_source_surface(self.surface, self.box[0], self.box[1])
+        ctx.rectangle(x0, y0, x1 - x0, y1 - y0)
+        ctx.fill()
+
+
+class Node(engine.Node):
 
     # Intersection test result type.
     BODY = 0
     TERMINAL = 1
 
-    # Terminal type.
-    INPUT = 0
-    OUTPUT = 1
-
     # Appearance.
     TEXT_COLOR = Color(0, 0, 0)
     BODY_COLOR = ColorPair(Color(0, 0, 0), Color(1, 1, 1))
@@ -160,6 +303,7 @@ class Node(object):
 
     CORNER_RADIUS = 10
     TERMINAL_RADIUS = 10
+    LINE_WIDTH = 4
     SQUISH_Y_FACTOR = 5
     SQUISH_X_FACTOR = 2
     TILT_FACTOR = 1
@@ -167,62 +311,179 @@ class Node(object):
     FONT_SIZE = 26
     TEXT_FILL_FACTOR = 0.7
 
+    # Animation phase is rounded to this many steps per beat, so bodies and
+    # shadows can be drawn from a limited set of pre-rendered sprites. Tilt
+    # repeats every two beats.
+    PHASE_STEPS = 32
+    PHASE_PERIOD = 2
+
+    # Squish and tilt for every phase step, shared by all nodes. Filled in
+    # on first use.
+    PHASE_TABLE = None
+    PhaseGeometry = namedtuple('PhaseGeometry', ['x_tilt', 'bottom', 'left',
+                                                 'extra_width',
+                                                 'extra_height'])
+
     Intersection = namedtuple('Intersection', ['type', 'value'])
 
     # Precalculated constants.
     TERMINAL_RADIUS_SQUARED = TERMINAL_RADIUS * TERMINAL_RADIUS
 
+    # Names of methods drawing node contents over the body, called as
+    # f(ctx, contents) with the origin at the node position.
+    DRAW_FUNCTIONS = ()
+
+    # Lock of nodes not told to use any other one.
+    NO_LOCK = nullcontext()
+
+    # No per-instance dictionary here either, see engine.Node.
+    __slots__ = ('title', 'func', 'deleter', 'on_move', 'edit_lock',
+                 'drawn_contents', 'orig_width', 'orig_height', 'phase',
+                 'phase_step', 'phase_getter', 'x_tilt', 'bottom', 'left',
+                 'width', 'height', 'top', 'terminal_positions', 'menu')
+
     def __init__(self, title="?", n_inputs=1, n_outputs=1, func=None, x=0, y=0,
                  width=100, height=100, deleter=lambda _: None,
-                 phase_getter=lambda: 0):
+                 phase_getter=lambda: 0, on_edit=lambda _: None,
+                 on_move=lambda _: None, edit_lock=None):
+        engine.Node.__init__(self, n_inputs=n_inputs, n_outputs=n_outputs,
+                             x=x, y=y, on_edit=on_edit)
         self.title = title
-        self.n_inputs = n_inputs
-        self.n_outputs = n_outputs
         self.func = func
         self.deleter = deleter
-        self.frozen = False
-        self.cached = Obj()
+        self.on_move = on_move
+        self.edit_lock = edit_lock if edit_lock is not None \
+            else Node.NO_LOCK
+        self.drawn_contents = None
 
         self.orig_width = width
         self.orig_height = height
-        self.x = x
-        self.y = y
-        self.value = ''
-        self.operation = ''
         self.phase = 0
+        self.phase_step = None
         self.phase_getter = phase_getter
+        self.terminal_positions = None
         self._update_phase(first_time=True)
         self.menu = None
-        self.draw_functions = []
-        self.input_values = {}
-        self.output_values = {}
 
     def move(self, x, y):
         self.x = x
         self.y = y
+        self.on_move(self)
+
+    def edit(self, function, *args):
+        # Changes node state from the UI. The lock is held across the change
+        # and its notification, so no calculation step runs in between and
+        # overwrites the change with state it had taken before.
+        with self.edit_lock:
+            function(*args)
+
+    def get_bounding_box(self):
+        # Absolute (x0, y0, x1, y1) box containing the node, its terminals
+        # and its shadow at any animation phase.
+        x0, y0, x1, y1 = self._get_relative_bounding_box()
+        return (self.x + x0, self.y + y0, self.x + x1, self.y + y1)
+
+    def _get_relative_bounding_box(self):
+        pad = Node.TERMINAL_RADIUS + Node.LINE_WIDTH / 2
+        pad_x = max(Node.SQUISH_X_FACTOR + Node.TILT_FACTOR + pad,
+                    0.1 * self.orig_width)
+        return (- pad_x,
+                - self.orig_height - Node.SQUISH_Y_FACTOR - pad,
+                self.orig_width + pad_x,
+                max(pad, 0.12 * self.orig_height))
 
     def get_pos(self):
         return Point(self.x, self.y)
 
+    def get_menu(self):
+        # Menus are created on first use, so nodes can be created without a
+        # display, and large schemas load without making a menu per node.
+        if self.menu is None:
+            self.menu = self._create_menu()
+        return self.menu
+
+    def _create_menu(self):
+        return None
+
+    def get_contents(self):
+        # Whatever calculation results the node displays, as an immutable
+        # value. It's taken after every step and passed back to draw(), and
+        # the node needs to be redrawn if it has changed.
+        return None
+
+    @staticmethod
+    def _get_phase_table():
+        if Node.PHASE_TABLE is not None:
+            return Node.PHASE_TABLE
+
+        table = []
+        for step in range(Node.PHASE_STEPS * Node.PHASE_PERIOD):
+            phase = step / Node.PHASE_STEPS
+            s = math.fabs(math.sin(math.pi * phase))
+            s2 = s * s
+            table.append(Node.PhaseGeometry(
+                x_tilt=Node.TILT_FACTOR * math.sin(math.pi * (phase + 0.5)),
+                bottom=Node.SQUISH_Y_FACTOR * (s ** (1.0/3) - 1),
+                left=- Node.SQUISH_X_FACTOR * s2 / 2.0,
+                extra_width=Node.SQUISH_X_FACTOR * s2,
+                extra_height=- Node.SQUISH_Y_FACTOR * s2))
+        Node.PHASE_TABLE = table
+        return table
+
     def _update_phase(self, first_time=False):
         phase = self.phase_getter() if not self.frozen else 0
-        if self.phase == phase and not first_time:
+        step = int(round(phase * Node.PHASE_STEPS))
+        step %= Node.PHASE_STEPS * Node.PHASE_PERIOD
+        if self.phase_step == step and not first_time:
             return
 
-        self.phase = phase
-        self.x_tilt = Node.TILT_FACTOR * math.sin(math.pi * (phase + 0.5))
-        s = math.fabs(math.sin(math.pi * phase))
-        s2 = s * s
-        self.bottom = Node.SQUISH_Y_FACTOR * (s ** (1.0/3) - 1)
-        self.left = - Node.SQUISH_X_FACTOR * s2 / 2.0
-        self.width = self.orig_width + Node.SQUISH_X_FACTOR * s2
-        self.height = self.orig_height - Node.SQUISH_Y_FACTOR * s2
+        self.phase = step / Node.PHASE_STEPS
+        self.phase_step = step
+        g = self._get_phase_table()[step]
+        self.x_tilt = g.x_tilt
+        self.bottom = g.bottom
+        self.left = g.left
+        self.width = self.orig_width + g.extra_width
+        self.height = self.orig_height + g.extra_height
         self.top = self.bottom - self.height
+        self.terminal_positions = None
+
+    def _get_sprite(self, key, box, draw_function):
+        # Sprites are positioned relative to the node origin. Their boxes
+        # are rounded outwards to whole pixels.
+        sprite = sprites.get(key)
+        if sprite is not None:
+            return sprite
+
+        x0, y0 = math.floor(box[0]), math.floor(box[1])
+        x1, y1 = math.ceil(box[2]), math.ceil(box[3])
+        surface = cairo.ImageSurface(cairo.Format.ARGB32, x1 - x0, y1 - y0)
+        ctx = cairo.Context(surface)
+        ctx.translate(-x0, -y0)
+        draw_function(ctx)
+        sprite = Obj(surface=surface, x=x0, y=y0)
+        sprites.put(key, sprite)
+        return sprite
+
+    def _blit(self, ctx, sprite):
+        # Whole pixel positions keep sprites sharp.
+        x = round(self.x) + sprite.x
+        y = round(self.y) + sprite.y
+        ctx.set_source_surface(sprite.surface, x, y)
+        ctx.rectangle(x, y, sprite.surface.get_width(),
+                      sprite.surface.get_height())
+        ctx.fill()
 
     def draw_shadow(self, ctx):
         self._update_phase()
+        key = ('shadow', self.orig_width, self.orig_height, self.phase_step)
+        box = (- 0.1 * self.orig_width, - 0.12 * self.orig_height,
+               1.1 * self.orig_width, 0.12 * self.orig_height)
+        self._blit(ctx, self._get_sprite(key, box, self._draw_shadow))
+
+    def _draw_shadow(self, ctx):
         ctx.save()
-        ctx.translate(self.x + self.orig_width * 0.5, self.y)
+        ctx.translate(self.orig_width * 0.5, 0)
         ctx.scale(1, 0.2)
         p = cairo.RadialGradient(0, 0, 0, 0, 0, self.orig_width * 0.5)
         p.add_color_stop_rgba(0, 0, 0, 0, 0.6)
@@ -234,11 +495,30 @@ class Node(object):
         ctx.fill()
         ctx.restore()
 
-    def draw(self, ctx, highlighted_terminal=None):
+    def draw(self, ctx, contents, highlighted_terminal=None):
         self._update_phase()
+        highlight = None
+        if highlighted_terminal is not None and \
+           highlighted_terminal.node == self:
+            highlight = (highlighted_terminal.terminal_type,
+                         highlighted_terminal.idx)
+
+        key = ('body', type(self), self.n_inputs, self.n_outputs,
+               self.orig_width, self.orig_height, self.phase_step,
+               self.frozen, highlight)
+        self._blit(ctx, self._get_sprite(
+            key, self._get_relative_bounding_box(),
+            lambda body_ctx: self._draw_body(body_ctx, highlight)))
+
         ctx.save()
         ctx.translate(self.x, self.y)
-        ctx.set_line_width(4)
+        for name in self.DRAW_FUNCTIONS:
+            getattr(self, name)(ctx, contents)
+        ctx.restore()
+        self.drawn_contents = contents
+
+    def _draw_body(self, ctx, highlight):
+        ctx.set_line_width(Node.LINE_WIDTH)
         draw_rounded_rectangle(ctx, self.left, self.top, self.width,
                                self.height, Node.CORNER_RADIUS, self.x_tilt)
         ctx.set_source_rgb(*(Node.FROZEN_COLOR.background if self.frozen
@@ -248,71 +528,56 @@ class Node(object):
                              else self.BODY_COLOR.foreground))
         ctx.stroke()
 
-        def highlighted(terminal_type, idx):
-            res = highlighted_terminal is not None and \
-                  highlighted_terminal.node == self and \
-                  highlighted_terminal.terminal_type == terminal_type and \
-                  highlighted_terminal.idx == idx
-            return res
-
-        for k in range(self.n_inputs):
-            c = self._get_terminal_pos(Node.INPUT, k)
-            ctx.arc(c.x, c.y, Node.TERMINAL_RADIUS, 0, 2 * math.pi)
-            bg_color = Node.HIGHLIGHT_COLOR if highlighted(Node.INPUT, k) \
-                else Node.TERMINAL_COLOR.background
-            ctx.set_source_rgb(*bg_color)
-            ctx.fill_preserve()
-            ctx.set_source_rgb(*Node.TERMINAL_COLOR.foreground)
-            ctx.stroke()
-
-        for k in range(self.n_outputs):
-            c = self._get_terminal_pos(Node.OUTPUT, k)
-            ctx.arc(c.x, c.y, self.TERMINAL_RADIUS, 0, 2 * math.pi)
-            bg_color = Node.HIGHLIGHT_COLOR if highlighted(Node.OUTPUT, k) \
-                else Node.TERMINAL_COLOR.background
-            ctx.set_source_rgb(*bg_color)
-            ctx.fill_preserve()
-            ctx.set_source_rgb(*Node.TERMINAL_COLOR.foreground)
-            ctx.stroke()
-
-        for df in self.draw_functions:
-            df(ctx)
-        ctx.restore()
+        for terminal_type, n in ((Node.INPUT, self.n_inputs),
+                                 (Node.OUTPUT, self.n_outputs)):
+            for k in range(n):
+                c = self._get_terminal_pos(terminal_type, k)
+                ctx.arc(c.x, c.y, Node.TERMINAL_RADIUS, 0, 2 * math.pi)
+                bg_color = Node.HIGHLIGHT_COLOR \
+                    if highlight == (terminal_type, k) \
+                    else Node.TERMINAL_COLOR.background
+                ctx.set_source_rgb(*bg_color)
+                ctx.fill_preserve()
+                ctx.set_source_rgb(*Node.TERMINAL_COLOR.foreground)
+                ctx.stroke()
 
     def get_title(self):
         return self.title
 
-    def freeze(self, freeze):
-        self.frozen = bool(freeze)
+    def _calculate_terminal_positions(self, n, x):
+        positions = []
+        for idx in range(n):
+            relative_y = (idx + 0.5) / n
+            positions.append(Point(x + (1 - relative_y) * self.x_tilt,
+                                   self.top + relative_y * self.height))
+        return positions
 
     def _get_terminal_pos(self, terminal_type, idx):
+        # Positions of all terminals are kept until the phase changes.
         self._update_phase()
-        if terminal_type == Node.INPUT:
-            if self.n_inputs == 0 or idx < 0 or idx >= self.n_inputs:
-                return None
-            relative_y = (idx + 0.5) / self.n_inputs
-            return Point(self.left + (1 - relative_y) * self.x_tilt,
-                         self.top + relative_y * self.height)
+        if self.terminal_positions is None:
+            self.terminal_positions = (
+                self._calculate_terminal_positions(self.n_inputs, self.left),
+                self._calculate_terminal_positions(self.n_outputs,
+                                                   self.left + self.width))
 
+        if terminal_type == Node.INPUT:
+            positions = self.terminal_positions[0]
         elif terminal_type == Node.OUTPUT:
-            if self.n_outputs == 0 or idx < 0 or idx >= self.n_outputs:
-                return None
-            relative_y = (idx + 0.5) / self.n_outputs
-            return Point(self.left + self.width +
-                         (1 - relative_y) * self.x_tilt,
-                         self.top + relative_y * self.height)
+            positions = self.terminal_positions[1]
         else:
             return None
 
+        if idx < 0 or idx >= len(positions):
+            return None
+        return positions[idx]
+
     def _get_terminal_absolute_pos(self, terminal_type, idx):
         pos = self._get_terminal_pos(terminal_type, idx)
         return Point(pos.x + self.x, pos.y + self.y)
 
-    def get_terminal(self, terminal_type, idx):
-        return Terminal(self, terminal_type, idx,
-                        lambda:
-                            self._get_terminal_absolute_pos(terminal_type,
-                                                            idx))
+    def _create_terminal(self, terminal_type, idx):
+        return Terminal(self, terminal_type, idx)
 
     def get_intersections(self, absolute_x, absolute_y):
         self._update_phase()
@@ -339,31 +604,6 @@ class Node(object):
 
         return None
 
-    def set_input(self, idx, value):
-        self.input_values[idx] = value
-
-    def set_output(self, idx, value):
-        self.output_values[idx] = value
-
-    def get_input(self, idx):
-        if idx in self.input_values:
-            return self.input_values[idx]
-        return None
-
-    def get_output(self, idx):
-        if idx in self.output_values:
-            return self.output_values[idx]
-        return None
-
-    def reset_inputs(self):
-        self.input_values = {}
-
-    def reset_outputs(self):
-        self.output_values = {}
-
-    def calculate(self):
-        raise Exception("override this method")
-
 
 def _generate_menu_from_description(menu_description, n_columns=1):
     menu = Gtk.Menu()
@@ -433,15 +673,17 @@ def ask_string(title='', description='', old_text=''):
 
 
 class TextNode(Node):
-    def __init__(self, **kwargs):
-        Node.__init__(self, **kwargs)
-        self.cached.text = None
-        self.cached.surface = None
-        self.draw_functions.append(self._render_title)
+    DRAW_FUNCTIONS = ('_render_title',)
+    __slots__ = ()
 
     def get_text_surface(self, ctx, text):
-        if self.cached.text == text:
-            return self.cached.surface
+        # Text is fitted into the node at rest, so all nodes of the same
+        # size showing the same text share a surface.
+        key = (text, self.FONT_FACE, self.FONT_SIZE, self.TEXT_COLOR,
+               self.TEXT_FILL_FACTOR, self.orig_width, self.orig_height)
+        surface = text_surfaces.get(key)
+        if surface is not None:
+            return surface
 
         layout = PangoCairo.create_layout(ctx)
         layout.set_text(text, -1)
@@ -450,8 +692,8 @@ class TextNode(Node):
         layout.set_font_description(descr)
         PangoCairo.update_layout(ctx, layout)
         t = layout.get_pixel_size()
-        scale = min(self.TEXT_FILL_FACTOR * self.width / (t.width + 1),
-                    self.TEXT_FILL_FACTOR * self.height / (t.height + 1))
+        scale = min(self.TEXT_FILL_FACTOR * self.orig_width / (t.width + 1),
+                    self.TEXT_FILL_FACTOR * self.orig_height / (t.height + 1))
         if scale < 1:
             descr.set_size(scale * Pango.SCALE * self.FONT_SIZE)
             layout.set_font_description(descr)
@@ -459,18 +701,19 @@ class TextNode(Node):
 
         t = layout.get_pixel_size()
 
-        surface = ctx.get_target().create_similar(cairo.Content.COLOR_ALPHA,
-                                                  t.width, t.height)
+        surface = cairo.ImageSurface(cairo.Format.ARGB32, t.width, t.height)
         new_ctx = cairo.Context(surface)
         new_ctx.set_source_rgb(*self.TEXT_COLOR)
         PangoCairo.show_layout(new_ctx, layout)
 
-        self.cached.surface = surface
-        self.cached.text = text
-        return self.cached.surface
+        text_surfaces.put(key, surface)
+        return surface
 
-    def _render_title(self, ctx):
-        surface = self.get_text_surface(ctx, self.get_title())
+    def get_contents(self):
+        return self.get_title()
+
+    def _render_title(self, ctx, title):
+        surface = self.get_text_surface(ctx, title)
         surf_width, surf_height = surface.get_width(), surface.get_height()
         ctx.save()
         ctx.translate(self.left + self.width / 2.0 - surf_width / 2.0,
@@ -480,16 +723,19 @@ class TextNode(Node):
         ctx.restore()
 
 
-class RegisterNode(TextNode):
+class RegisterNode(TextNode, engine.RegisterNode):
+    __slots__ = ()
+
     def __init__(self, value=0, **kwargs):
         TextNode.__init__(self, n_inputs=1, n_outputs=1, **kwargs)
         self.value = value
 
-        self.menu = _generate_menu_from_description((
+    def _create_menu(self):
+        return _generate_menu_from_description((
             ('Register Node', 'title', None),
             ('Set Value', 'item', lambda _: self.invoke_ask_value_dialog()),
-            ('Freeze', 'item', lambda _: self.freeze(True)),
-            ('Thaw', 'item', lambda _: self.freeze(False)),
+            ('Freeze', 'item', lambda _: self.edit(self.freeze, True)),
+            ('Thaw', 'item', lambda _: self.edit(self.freeze, False)),
             ('Remove', 'item', lambda _: self.deleter(self)),
         ), n_columns=1)
 
@@ -501,217 +747,377 @@ class RegisterNode(TextNode):
                           description='Enter new constant value:',
                           old_text=str(self.value))
         if text:
-            self.value = force_int(text, 0)
-            self.set_output(0, self.value)
+            with self.edit_lock:
+                self.value = force_int(text, 0)
+                self.set_output(0, self.value)
+                self.mark_edited()
 
-    def calculate(self):
-        if not self.frozen:
-            input_0 = self.get_input(0)
-            if input_0 is not None:
-                self.value = force_int(input_0)
 
-        self.set_output(0, self.value)
+class ArithmeticNode(TextNode, engine.ArithmeticNode):
+    __slots__ = ()
 
-
-class ArithmeticNode(TextNode):
     def __init__(self, operation='+', **kwargs):
         TextNode.__init__(self, n_inputs=2, n_outputs=1, **kwargs)
         self.operation = operation
         self.value = None
 
-        self.menu = _generate_menu_from_description((
+    def _create_menu(self):
+        return _generate_menu_from_description((
             ('Arithmetic Node', 'title', None),
-            ('Freeze', 'item', lambda _: self.freeze(True)),
-            ('Thaw', 'item', lambda _: self.freeze(False)),
-            ('(+)', 'item', lambda _: self.set_operation('+')),
-            ('(×)', 'item', lambda _: self.set_operation('×')),
-            ('(-)', 'item', lambda _: self.set_operation('-')),
-            ('(/)', 'item', lambda _: self.set_operation('/')),
-            ('(%)', 'item', lambda _: self.set_operation('%')),
+            ('Freeze', 'item', lambda _: self.edit(self.freeze, True)),
+            ('Thaw', 'item', lambda _: self.edit(self.freeze, False)),
+            ('(+)', 'item', lambda _: self.edit(self.set_operation, '+')),
+            ('(×)', 'item', lambda _: self.edit(self.set_operation, '×')),
+            ('(-)', 'item', lambda _: self.edit(self.set_operation, '-')),
+            ('(/)', 'item', lambda _: self.edit(self.set_operation, '/')),
+            ('(%)', 'item', lambda _: self.edit(self.set_operation, '%')),
             ('Remove', 'item', lambda _: self.deleter(self)),
         ), n_columns=2)
 
-    def set_operation(self, operation):
-        self.operation = operation
-
     def get_title(self):
         return self.operation
 
-    def calculate(self):
-        input_0 = self.get_input(0)
-        input_1 = self.get_input(1)
-        if input_0 is not None and input_1 is not None:
-            input_0 = force_int(input_0)
-            input_1 = force_int(input_1)
-            if self.operation == '+':
-                self.value = input_0 + input_1
-            elif self.operation == '×':
-                self.value = input_0 * input_1
-            elif self.operation == '-':
-                self.value = input_0 - input_1
-            elif self.operation == '/':
-                self.value = None if input_1 == 0 else input_0 // input_1
-            elif self.operation == '%':
-                self.value = None if input_1 == 0 else input_0 % input_1
-            else:
-                self.value = None
-        else:
-            self.value = None
-
-        self.set_output(0, self.value)
 
+class PointNode(TextNode, engine.PointNode):
+    __slots__ = ()
 
-class PointNode(TextNode):
     def __init__(self, **kwargs):
         TextNode.__init__(self, n_inputs=2, n_outputs=1, **kwargs)
-        self.menu = _generate_menu_from_description((
+        self.value = None
+        self.set_output(0, self.value)
+
+    def _create_menu(self):
+        return _generate_menu_from_description((
             ('Point Node', 'title', None),
-            ('Freeze', 'item', lambda _: self.freeze(True)),
-            ('Thaw', 'item', lambda _: self.freeze(False)),
+            ('Freeze', 'item', lambda _: self.edit(self.freeze, True)),
+            ('Thaw', 'item', lambda _: self.edit(self.freeze, False)),
             ('Remove', 'item', lambda _: self.deleter(self)),
         ), n_columns=1)
-        self.value = None
-        self.set_output(0, self.value)
 
     def get_title(self):
         return '(x, y)'
 
-    def calculate(self):
-        if self.frozen:
-            return
 
-        input_0 = self.get_input(0)
-        input_1 = self.get_input(1)
-        if input_0 is not None and input_1 is not None:
-            self.value = Point(force_int(input_0), force_int(input_1))
-        else:
-            self.value = None
-
-        self.set_output(0, self.value)
-
-
-class GraphNode(Node):
+class GraphNode(Node, engine.GraphNode):
     FILL_FACTOR = 0.9
-    NX = 40
-    NY = 40
     GRID_LINE_COLOR = Color(0, 0, 0)
     POINT_COLOR = Color(1, 0, 1)
     GRID_LINE_WIDTH = 0.2
+    MIN_GRID_STEP = 3  # px, denser grids are not drawn
+    DRAW_FUNCTIONS = ('_render_graphics',)
+    __slots__ = ('plot_surface', 'plot_source', 'plot_drawn')
 
-    def __init__(self, **kwargs):
+    def __init__(self, nx=None, ny=None, **kwargs):
         Node.__init__(self, n_inputs=8, n_outputs=0, width=300, height=300,
                       **kwargs)
-        self.menu = _generate_menu_from_description((
+        self._create_plot(nx or self.NX, ny or self.NY)
+
+        # Plot image, one pixel per cell, and how much of `plotted` it shows.
+        self.plot_surface = None
+        self.plot_source = None
+        self.plot_drawn = 0
+
+    def _create_menu(self):
+        return _generate_menu_from_description((
             ('Graph Node', 'title', None),
-            ('Clear', 'item', lambda _: self.clear()),
+            ('Clear', 'item', lambda _: self.edit(self.clear)),
             ('Remove', 'item', lambda _: self.deleter(self)),
         ), n_columns=1)
 
-        self.draw_functions.append(self._render_graphics)
-        self.pixels = set()
-
-    def _render_graphics(self, ctx):
-        left = self.left + self.width * (1 - self.FILL_FACTOR) / 2
-        top = self.top + self.height * (1 - self.FILL_FACTOR) / 2
-        width = self.width * self.FILL_FACTOR
-        height = self.height * self.FILL_FACTOR
-
-        x_step = width / self.NX
-        y_step = height / self.NY
+    def get_contents(self):
+        # Cells are only appended to `plotted` until a clear replaces it, so
+        # its first `count` items never change.
+        return (len(self.plotted), self.plotted)
+
+    def get_plot_surface(self, contents):
+        # A8 image with a pixel per cell, bottom row last. Only the cells
+        # plotted since the last call are set.
+        count, plotted = contents
+        if self.plot_source is not plotted or self.plot_drawn > count:
+            self.plot_surface = cairo.ImageSurface(cairo.Format.A8, self.nx,
+                                                   self.ny)
+            self.plot_source = plotted
+            self.plot_drawn = 0
+
+        surface = self.plot_surface
+        if self.plot_drawn == count:
+            return surface
+
+        surface.flush()
+        data = surface.get_data()
+        stride = surface.get_stride()
+        for k in plotted[self.plot_drawn:count]:
+            y, x = divmod(k, self.nx)
+            data[(self.ny - 1 - y) * stride + x] = 255
+        surface.mark_dirty()
+        self.plot_drawn = count
+        return surface
+
+    def _draw_grid(self, ctx):
+        width = self.orig_width * self.FILL_FACTOR
+        height = self.orig_height * self.FILL_FACTOR
+        x_step = width / self.nx
+        y_step = height / self.ny
+        if min(x_step, y_step) < self.MIN_GRID_STEP:
+            return
 
         ctx.set_source_rgb(*self.GRID_LINE_COLOR)
         ctx.set_line_width(self.GRID_LINE_WIDTH)
 
-        for k in range(0, self.NX + 1):
-            ctx.move_to(left + k * x_step, top)
-            ctx.line_to(left + k * x_step, top + height)
+        for k in range(0, self.nx + 1):
+            ctx.move_to(k * x_step, 0)
+            ctx.line_to(k * x_step, height)
 
-        for k in range(0, self.NY + 1):
-            ctx.move_to(left, top + k * y_step)
-            ctx.line_to(left + width, top + k * y_step)
+        for k in range(0, self.ny + 1):
+            ctx.move_to(0, k * y_step)
+            ctx.line_to(width, k * y_step)
 
         ctx.stroke()
 
-        ctx.set_source_rgb(*self.POINT_COLOR)
-        for p in self.pixels:
-            if 0 <= p.x and p.x < self.NX and 0 <= p.y and p.y < self.NY:
-                ctx.rectangle(left + x_step * p.x,
-                              top + height - y_step * p.y - y_step,
-                              x_step, y_step)
+    def _render_graphics(self, ctx, contents):
+        # Grid and plot are drawn at rest size once, and then scaled to the
+        # current size of the node.
+        left = self.left + self.width * (1 - self.FILL_FACTOR) / 2
+        top = self.top + self.height * (1 - self.FILL_FACTOR) / 2
+        width = self.width * self.FILL_FACTOR
+        height = self.height * self.FILL_FACTOR
+        rest_width = self.orig_width * self.FILL_FACTOR
+        rest_height = self.orig_height * self.FILL_FACTOR
 
-        ctx.fill()
+        grid = self._get_sprite(
+            ('grid', self.nx, self.ny, rest_width, rest_height),
+            (0, 0, rest_width, rest_height), self._draw_grid)
+        ctx.save()
+        ctx.translate(left, top)
+        ctx.scale(width / rest_width, height / rest_height)
+        ctx.set_source_surface(grid.surface, grid.x, grid.y)
+        ctx.paint()
+        ctx.restore()
 
-    def calculate(self):
-        for k in range(self.n_inputs):
-            input_val = self.get_input(k)
-            if type(input_val) == Point:
-                self.pixels.add(input_val)
+        pattern = cairo.SurfacePattern(self.get_plot_surface(contents))
+        # Cells stay sharp while they are larger than a pixel.
+        pattern.set_filter(cairo.Filter.NEAREST if width >= self.nx
+                           else cairo.Filter.GOOD)
+        ctx.save()
+        ctx.translate(left, top)
+        ctx.scale(width / self.nx, height / self.ny)
+        ctx.set_source_rgb(*self.POINT_COLOR)
+        ctx.mask(pattern)
+        ctx.restore()
 
-    def clear(self):
-        self.pixels = set()
 
+class ConditionalNode(TextNode, engine.ConditionalNode):
+    __slots__ = ()
 
-class ConditionalNode(TextNode):
     def __init__(self, operation='>', **kwargs):
         TextNode.__init__(self, n_inputs=4, n_outputs=1, height=150, **kwargs)
         self.operation = operation
         self.value = None
 
-        self.menu = _generate_menu_from_description((
+    def _create_menu(self):
+        return _generate_menu_from_description((
             ('Conditional Node', 'title', None),
-            ('Freeze', 'item', lambda _: self.freeze(True)),
-            ('Thaw', 'item', lambda _: self.freeze(False)),
-            ('(>)', 'item', lambda _: self.set_operation('>')),
-            ('(<)', 'item', lambda _: self.set_operation('<')),
-            ('(=)', 'item', lambda _: self.set_operation('=')),
-            ('(≠)', 'item', lambda _: self.set_operation('≠')),
-            ('(≥)', 'item', lambda _: self.set_operation('≥')),
-            ('(≤)', 'item', lambda _: self.set_operation('≤')),
+            ('Freeze', 'item', lambda _: self.edit(self.freeze, True)),
+            ('Thaw', 'item', lambda _: self.edit(self.freeze, False)),
+            ('(>)', 'item', lambda _: self.edit(self.set_operation, '>')),
+            ('(<)', 'item', lambda _: self.edit(self.set_operation, '<')),
+            ('(=)', 'item', lambda _: self.edit(self.set_operation, '=')),
+            ('(≠)', 'item', lambda _: self.edit(self.set_operation, '≠')),
+            ('(≥)', 'item', lambda _: self.edit(self.set_operation, '≥')),
+            ('(≤)', 'item', lambda _: self.edit(self.set_operation, '≤')),
             ('Remove', 'item', lambda _: self.deleter(self)),
         ), n_columns=2)
 
-    def set_operation(self, operation):
-        self.operation = operation
-
     def get_title(self):
         return self.operation
 
-    def calculate(self):
-        input_0 = self.get_input(0)
-        input_1 = self.get_input(1)
-        condition_holds = False
-        if input_0 is not None and input_1 is not None:
-            input_0 = force_int(input_0)
-            input_1 = force_int(input_1)
 
-            if self.operation == '>':
-                condition_holds = (input_0 > input_1)
+NODE_CLASSES = {node_class.__name__: node_class
+                for node_class in (RegisterNode, ArithmeticNode, PointNode,
+                                   GraphNode, ConditionalNode)}
+
+
+class Scene(object):
+    # Nodes and wires of a schema placed on the canvas, and their drawing.
+    # No Gtk widgets are involved, so scenes can be rendered offscreen too.
+
+    CANVAS_COLOR = Color(0.3, 0.5, 0.5)
+    GRID_STEP = 50
+    GRID_MAJOR_EVERY = 5
+
+    def __init__(self):
+        self.graph = engine.Graph()
+        self.node_index = GridIndex()
+        self.wire_layer = WireLayer()
+        self.frozen_layer = FrozenLayer()
+        self.grid_pattern = None
+
+    @property
+    def nodes(self):
+        return self.graph.nodes
+
+    @property
+    def wires(self):
+        return self.graph.wires
+
+    def add_node(self, node):
+        self.graph.add_node(node)
+        self.node_index.insert(node, node.get_bounding_box())
+
+    def load(self, node_records, wire_records, create_node, phase_getter):
+        # Adds nodes and wires from schema records, yielding the fraction of
+        # work done every few nodes. Nodes are made by
+        # create_node(node_class, x, y).
+        total = max(len(node_records) + len(wire_records), 1)
+
+        nodes = []
+        for k, record in enumerate(node_records):
+            node_class = NODE_CLASSES.get(record.type)
+            if node_class is not None:
+                obj = create_node(node_class, record.x, record.y)
+                obj.value = record.value
+                obj.frozen = record.frozen
+                obj.operation = record.operation
+                self.add_node(obj)
+            else:
+                obj = None
+            nodes.append(obj)
+            if k % 16 == 0:
+                yield k / total
+
+        for k, record in enumerate(wire_records):
+            start_node = nodes[record.start_node]
+            end_node = nodes[record.end_node]
+            if start_node is not None and end_node is not None:
+                self.graph.add_wire(Wire(
+                    start=start_node.get_terminal(Node.OUTPUT,
+                                                  record.start_idx),
+                    end=end_node.get_terminal(Node.INPUT, record.end_idx),
+                    phase_getter=phase_getter))
+            if k % 256 == 0:
+                yield (len(node_records) + k) / total
+
+    def get_grid_pattern(self):
+        # The grid repeats every five steps, so one such tile is rendered
+        # once, and then the whole background is filled with it.
+        if self.grid_pattern is not None:
+            return self.grid_pattern
+
+        period = self.GRID_STEP * self.GRID_MAJOR_EVERY
+        tile = cairo.ImageSurface(cairo.Format.RGB24, period, period)
+        ctx = cairo.Context(tile)
+        ctx.set_source_rgb(*self.CANVAS_COLOR)
+        ctx.paint()
+
+        # Lines on both edges, so that each half of a line lying on a tile
+        # boundary gets drawn.
+        ctx.set_source_rgb(0, 0, 0)
+        for n in range(self.GRID_MAJOR_EVERY + 1):
+            ctx.set_line_width(0.3 if n % self.GRID_MAJOR_EVERY == 0
+                               else 0.15)
+            ctx.move_to(n * self.GRID_STEP, 0)
+            ctx.line_to(n * self.GRID_STEP, period)
+            ctx.move_to(0, n * self.GRID_STEP)
+            ctx.line_to(period, n * self.GRID_STEP)
+            ctx.stroke()
 
-            elif self.operation == '<':
-                condition_holds = (input_0 < input_1)
+        self.grid_pattern = cairo.SurfacePattern(tile)
+        self.grid_pattern.set_extend(cairo.Extend.REPEAT)
+        return self.grid_pattern
 
-            elif self.operation == '=':
-                condition_holds = (input_0 == input_1)
+    def draw_canvas(self, ctx, origin):
+        period = self.GRID_STEP * self.GRID_MAJOR_EVERY
+        pattern = self.get_grid_pattern()
+        pattern.set_matrix(cairo.Matrix(x0=origin.x % period,
+                                        y0=origin.y % period))
+        ctx.set_source(pattern)
+        ctx.paint()
 
-            elif self.operation == '≠':
-                condition_holds = (input_0 != input_1)
+        ctx.save()
+        ctx.set_source_rgba(0, 0, 0, 0.2)
+        ctx.arc(-origin.x, -origin.y, 5, 0, 2 * math.pi)
+        ctx.fill()
+        ctx.restore()
 
-            elif self.operation == '≥':
-                condition_holds = (input_0 >= input_1)
+    def query_point(self, x, y):
+        # Nodes whose bounding box may contain the point, in the order they
+        # are seen from above: live ones over the frozen layer, each topmost
+        # first.
+        nodes = self.node_index.query_point(x, y)
+        return [node for node in nodes if not node.frozen] + \
+            [node for node in nodes if node.frozen]
+
+    def get_visible_nodes(self, viewport):
+        return [node for node in self.node_index.query_rect(viewport)
+                if boxes_intersect(node.get_bounding_box(), viewport)]
+
+    def draw_wires(self, ctx, viewport):
+        # Returns the number of wires drawn. Those between two frozen nodes
+        # are in the frozen layer.
+        return len(self.wire_layer.draw(
+            ctx, (wire for wire in self.wires if wire.is_animated()),
+            viewport))
+
+    def draw_frozen(self, ctx, area, viewport, contents):
+        # The frozen layer is built for the whole visible `area` at once,
+        # and drawn within `viewport`.
+        layer = self.frozen_layer
+        if not layer.covers(area, contents):
+            layer.render(area, contents, self._draw_frozen)
+        layer.draw(ctx, viewport)
+
+    def _draw_frozen(self, ctx, box, contents):
+        wires = self.wire_layer.draw(
+            ctx, (wire for wire in self.wires if not wire.is_animated()), box)
+        nodes = [node for node in self.get_visible_nodes(box) if node.frozen]
+        self.draw_shadows(ctx, nodes)
+        self.draw_nodes(ctx, nodes, contents)
+        return nodes, wires
+
+    def draw_shadows(self, ctx, nodes):
+        for node in nodes:
+            node.draw_shadow(ctx)
 
-            elif self.operation == '≤':
-                condition_holds = (input_0 <= input_1)
+    def draw_nodes(self, ctx, nodes, contents, highlighted_terminal=None):
+        # Contents are taken from a snapshot, see Evaluator.
+        for node in nodes:
+            node.draw(ctx, contents.get(node),
+                      highlighted_terminal=highlighted_terminal)
 
-        if condition_holds:
-            self.set_output(0, self.get_input(2))
-        else:
-            self.set_output(0, self.get_input(3))
+    def draw(self, ctx, origin, width, height, contents):
+        # Whole canvas in the window coordinates, as the window draws it.
+        self.draw_canvas(ctx, origin)
+        ctx.save()
+        ctx.translate(- origin.x, - origin.y)
+        viewport = (origin.x, origin.y, origin.x + width, origin.y + height)
+        self.draw_wires(ctx, viewport)
+        self.draw_frozen(ctx, viewport, viewport, contents)
+        nodes = [node for node in self.get_visible_nodes(viewport)
+                 if not node.frozen]
+        self.draw_shadows(ctx, nodes)
+        self.draw_nodes(ctx, nodes, contents)
+        ctx.restore()
 
 
 class Showtime(Gtk.Window):
 
     CANVAS_MOVE_SPEED = 1
-    GRID_STEP = 50
+    FRAME_INTERVAL = 16  # ms
+
+    # Damage tracking. Box padding covers wire ends that follow animated
+    # terminals. With too many damaged boxes, the whole window is redrawn.
+    DAMAGE_PAD = 8
+    MAX_DAMAGE_BOXES = 64
+    METAINFO_WIDTH = 1000
+    METAINFO_HEIGHT = 190  # px, text lines above the profile overlay
+    PROFILE_TOP = 99  # baseline of the first overlay row, at 2x scale
+    PROFILE_ROW_HEIGHT = 10  # at 2x scale
+
+    # Saving and loading. Loaded nodes are created on the main thread, a few
+    # milliseconds' worth per frame.
+    AUTOSAVE_FILENAME = 'autosave' + schema.BINARY_SUFFIX
+    AUTOSAVE_INTERVAL = 60  # s
+    LOAD_TIME_BUDGET = 0.004  # s per frame
 
     # states
     class State:
@@ -724,7 +1130,7 @@ class Showtime(Gtk.Window):
         Gtk.Window.__init__(self, title="Showtime Komputeishon")
 
         self.set_size_request(1366, 768)
-        self.connect('destroy', Gtk.main_quit)
+        self.connect('destroy', self.handle_destroy)
 
         drawing_area = Gtk.DrawingArea()
         drawing_area.connect('draw', self.handle_draw_event)
@@ -755,37 +1161,82 @@ class Showtime(Gtk.Window):
         self.current.node = None
         self.current.highlighted_terminal = None
         self.current.element = None
-        self.nodes = []
-        self.wires = []
-        self.bpm = bpm
-        self.frame_timestamps = set()
-        self.fps = 0
-        self.next_step = int(time.time() * self.bpm / 60.0 + 1)
+        self.scene = Scene()
+        self.scheduler = engine.Scheduler()
+        self.clock = BeatClock(bpm)
+        self.evaluator = Evaluator(self.clock, self.calculate,
+                                   self.take_snapshot)
+        self.drawn_step = 0
+        self.frame_counter = FrameCounter(budget=self.FRAME_INTERVAL / 1000.0)
+        self.culling = Obj(nodes_drawn=0, nodes_culled=0,
+                           wires_drawn=0, wires_culled=0,
+                           frozen_nodes=0, frozen_wires=0)
+        self.profiler = Profiler()
+        self.show_profile = False
         self.surface = None
-
-        GLib.timeout_add(16, self.handle_tick)
+        self.state_filename = 'state.json'
+        self.animate = True
+        self.damage_tracking = False
+        self.damage = Obj(full=True, boxes=[])
+        self.job = None
+        self.loader = None
+        self.autosave = False
+        self.next_autosave = None
+
+        GLib.timeout_add(self.FRAME_INTERVAL, self.handle_tick)
+        self.evaluator.start()
+
+    def _create_node(self, node_class, x, y):
+        return node_class(deleter=self._delete_node,
+                          phase_getter=self._phase_func,
+                          on_edit=self._node_edited,
+                          on_move=self._node_moved,
+                          edit_lock=self.evaluator.lock,
+                          x=x, y=y)
 
     def add_node_at(self, node_class, x, y):
-        node = node_class(deleter=self._delete_node,
-                          phase_getter=self._phase_func,
-                          x=(self.current.origin.x + x),
-                          y=(self.current.origin.y + y))
-        self.nodes.append(node)
+        node = self._create_node(node_class, self.current.origin.x + x,
+                                 self.current.origin.y + y)
+        with self.evaluator.lock:
+            self.scene.graph.add_node(node)
+            self.scheduler.invalidate()
+            self.evaluator.refresh([node])
+        self.scene.node_index.insert(node, node.get_bounding_box())
+        self.damage_all()
         return node
 
+    def _node_edited(self, node):
+        # Freezing and thawing come here too.
+        with self.evaluator.lock:
+            self.scheduler.node_edited(node)
+            self.evaluator.refresh([node])
+        self.scene.frozen_layer.node_changed(node)
+        self.damage_all()
+
+    def _node_moved(self, node):
+        self.scene.node_index.update(node, node.get_bounding_box())
+        self.scene.frozen_layer.node_changed(node)
+        self.damage_all()
+
     def _delete_node(self, node):
-        self.nodes = list(filter(lambda n: n != node, self.nodes))
-        self.wires = list(filter(lambda w: w.start.node != node and
-                                 w.end.node != node,
-                                 self.wires))
+        with self.evaluator.lock:
+            self.scene.graph.remove_node(node)
+            self.scheduler.invalidate()
+        self.scene.node_index.remove(node)
+        self.scene.frozen_layer.node_changed(node)
+        self.damage_all()
 
     def _disconnect_terminal(self, terminal):
         if self.current.element is None or \
            self.current.element.type != Node.TERMINAL:
             return
         t = self.current.element.value
-        self.wires = list(filter(lambda w: w.start != t and w.end != t,
-                                 self.wires))
+        with self.evaluator.lock:
+            for wire in self.scene.graph.get_terminal_wires(t):
+                self.scene.graph.remove_wire(wire)
+                self.scene.frozen_layer.wire_changed(wire)
+            self.scheduler.invalidate()
+        self.damage_all()
 
     def _create_menus(self):
         self.menus = Obj()
@@ -803,8 +1254,8 @@ class Showtime(Gtk.Window):
              lambda _: self.add_node_at(GraphNode, *self.current.pos)),
             ('', 'separator', None),
             ('Schema', 'title', None),
-            ('Save', 'item', lambda _: print('TODO: save')),
-            ('Load', 'item', lambda _: print('TODO: load')),
+            ('Save', 'item', lambda _: self.save_state()),
+            ('Load', 'item', lambda _: self.restore_state()),
         ), n_columns=2)
 
         self.menus.terminal = _generate_menu_from_description((
@@ -812,61 +1263,30 @@ class Showtime(Gtk.Window):
             ('Disconnect', 'item', self._disconnect_terminal),
         ), n_columns=1)
 
+    @property
+    def nodes(self):
+        return self.scene.nodes
+
+    @property
+    def wires(self):
+        return self.scene.wires
+
     def _phase_func(self):
-        return self.phase
+        return self.phase if self.animate else 0
 
     def add_wire(self, start, end):
-        if start.node == end.node:
+        terminals = engine.orient_wire(start, end)
+        if terminals is None:
             return
 
-        wire_ends = (start.terminal_type, end.terminal_type)
-        if wire_ends == (Node.INPUT, Node.OUTPUT):
-            start, end = end, start
-        elif wire_ends == (Node.OUTPUT, Node.INPUT):
-            pass  # Just what we wanted.
-        else:
-            # Ignoring input-input and output-output wires.
-            return
-
-        self.wires = list(filter(lambda w: w.end != end, self.wires))
-        wire = Wire(start=start, end=end, phase_getter=self._phase_func)
-        self.wires.append(wire)
-
-    def draw_canvas(self, geometry, ctx):
-        ctx.set_source_rgb(0.3, 0.5, 0.5)
-        ctx.paint()
-
-        ctx.set_source_rgb(0, 0, 0)
-
-        gx = int(self.current.origin.x / self.GRID_STEP)
-        gy = int(self.current.origin.y / self.GRID_STEP)
-
-        x = gx * self.GRID_STEP - self.current.origin.x
-        n = gx
-        while x < geometry.width:
-            ctx.set_line_width(0.3 if n % 5 == 0 else 0.15)
-            ctx.move_to(x, 0)
-            ctx.line_to(x, geometry.height)
-            ctx.stroke()
-            x += self.GRID_STEP
-            n += 1
-
-        y = gy * self.GRID_STEP - self.current.origin.y
-        n = gy
-        while y < geometry.height:
-            ctx.set_line_width(0.3 if n % 5 == 0 else 0.15)
-            ctx.move_to(0, y)
-            ctx.line_to(geometry.width, y)
-            ctx.stroke()
-            y += self.GRID_STEP
-            n += 1
-
-        ctx.save()
-        ctx.set_source_rgba(0, 0, 0, 0.2)
-        ctx.arc(-self.current.origin.x, -self.current.origin.y,
-                5, 0, 2 * math.pi)
-        ctx.fill()
-        ctx.restore()
+        start, end = terminals
+        with self.evaluator.lock:
+            self.scene.graph.add_wire(Wire(start=start, end=end,
+                                           phase_getter=self._phase_func))
+            self.scheduler.invalidate()
+        # The wire may replace a frozen one, also ending at this input.
+        self.scene.frozen_layer.node_changed(end.node)
+        self.damage_all()
 
     def draw_metainfo(self, ctx):
         ctx.save()
@@ -878,20 +1298,83 @@ class Showtime(Gtk.Window):
         ctx.show_text('nodes: {}'.format(len(self.nodes)))
         ctx.move_to(2, 29)
         ctx.show_text('wires: {}'.format(len(self.wires)))
+        fc = self.frame_counter
         ctx.move_to(2, 39)
-        ctx.show_text('fps: {}'.format(self.fps))
+        ctx.show_text('fps: {:.0f}, frame time: mean {:.1f}, p95 {:.1f}, '
+                      'p99 {:.1f} ms, dropped: {}'.format(
+                          fc.get_fps(), 1000 * fc.get_mean(),
+                          1000 * fc.get_percentile(95),
+                          1000 * fc.get_percentile(99), fc.dropped))
+        ctx.move_to(2, 49)
+        ctx.show_text('drawn: {} nodes, {} wires; frozen layer: {} nodes, '
+                      '{} wires'.format(
+                          self.culling.nodes_drawn, self.culling.wires_drawn,
+                          self.culling.frozen_nodes,
+                          self.culling.frozen_wires))
+        ctx.move_to(2, 59)
+        ctx.show_text('culled: {} nodes, {} wires'.format(
+                      self.culling.nodes_culled, self.culling.wires_culled))
+        ctx.move_to(2, 69)
+        ctx.show_text('cached: {} sprites, {:.1f} MiB, {:.0%} hits; '
+                      '{} texts, {:.1f} MiB, {:.0%} hits'.format(
+                          len(sprites), sprites.size / (1024 * 1024),
+                          sprites.get_hit_rate(), len(text_surfaces),
+                          text_surfaces.size / (1024 * 1024),
+                          text_surfaces.get_hit_rate()))
+        ctx.move_to(2, 79)
+        jitter = self.clock.get_jitter()
+        ctx.show_text('beats: {}, late: p95 {:.1f}, p99 {:.1f}, max {:.1f} '
+                      'ms, {} coalesced, {} dropped, catch up: {}'.format(
+                          self.clock.beats, jitter['p95'], jitter['p99'],
+                          jitter['max'], self.clock.coalesced,
+                          self.clock.dropped, self.clock.policy))
+        ctx.move_to(2, 89)
+        ctx.show_text(self.get_job_status())
         ctx.restore()
 
-    def update_fps_counter(self):
-        current_timestamp = time.time()
-        self.frame_timestamps = \
-            set(filter(lambda ts: ts > current_timestamp - 1,
-                       self.frame_timestamps))
-        self.frame_timestamps.add(current_timestamp)
-        self.fps = len(self.frame_timestamps)
+        if self.show_profile:
+            self.draw_profile(ctx)
+
+    def draw_profile(self, ctx):
+        # Frame time percentiles per stage, with bars relative to the frame
+        # budget.
+        budget_ms = 16
+        bar_width = 100
+        ctx.save()
+        ctx.scale(2, 2)
+        ctx.select_font_face('monospace')
+        y = self.PROFILE_TOP
+        for name, stats in self.profiler.summary().items():
+            ctx.set_source_rgb(0, 0, 0)
+            ctx.move_to(2, y)
+            ctx.show_text('{:9} p50 {:6.2f} p95 {:6.2f} p99 {:6.2f} ms'.format(
+                          name, stats['p50'], stats['p95'], stats['p99']))
+            for key, shade in (('p99', 0.8), ('p95', 0.5), ('p50', 0.2)):
+                width = min(1, stats[key] / budget_ms) * bar_width
+                ctx.set_source_rgb(shade, shade, shade)
+                ctx.rectangle(280, y - 7, width, 7)
+                ctx.fill()
+            ctx.set_source_rgb(1, 0, 0)
+            ctx.rectangle(280 + bar_width, y - 8, 0.5, 9)
+            ctx.fill()
+            y += self.PROFILE_ROW_HEIGHT
+        ctx.restore()
+
+    def get_metainfo_area(self):
+        # Window area (x, y, width, height) of the statistics, which change
+        # with every drawn frame. The profile overlay gets a row per stage.
+        height = self.METAINFO_HEIGHT
+        if self.show_profile:
+            height += 2 * self.PROFILE_ROW_HEIGHT * len(self.profiler.stages)
+        return (0, 0, self.METAINFO_WIDTH, height)
+
+    def dump_profile(self):
+        self.profiler.dump_json('profile.json')
+        self.profiler.dump_csv('profile.csv')
+        print('profile saved to profile.json and profile.csv')
 
-        # Avoid flickering 61/60.
-        self.fps = self.fps if self.fps != 61 else 60
+    def update_fps_counter(self):
+        self.frame_counter.tick(time.monotonic())
 
     def get_cached_image_surface(self, width, height):
         if self.surface is not None and \
@@ -902,69 +1385,238 @@ class Showtime(Gtk.Window):
         self.surface = cairo.ImageSurface(cairo.Format.RGB24, width, height)
         return self.surface
 
+    def get_viewport(self):
+        a = self.drawing_area.get_allocation()
+        return (self.current.origin.x, self.current.origin.y,
+                self.current.origin.x + a.width,
+                self.current.origin.y + a.height)
+
+    def damage_all(self):
+        self.damage.full = True
+
+    def damage_box(self, bbox):
+        # Marks a box in canvas coordinates for redrawing.
+        if bbox is not None:
+            self.damage.boxes.append(bbox)
+
+    def collect_damage(self, stepped):
+        # Boxes of animated things, and of nodes whose contents were changed
+        # by a calculation step. Edits, moves and pointer actions report
+        # their damage as they happen.
+        if self.damage.full:
+            return
+
+        viewport = self.get_viewport()
+        contents = self.evaluator.snapshot.contents
+        for node in self.scene.node_index.query_rect(viewport):
+            animated = self.animate and not node.frozen
+            if not animated and not (stepped and contents.get(node) !=
+                                     node.drawn_contents):
+                continue
+            bbox = node.get_bounding_box()
+            if boxes_intersect(bbox, viewport):
+                self.damage_box(bbox)
+
+        if self.animate:
+            for wire in self.wires:
+                if not wire.is_animated():
+                    continue
+                bbox = wire.get_bounding_box()
+                if bbox is not None and boxes_intersect(bbox, viewport):
+                    self.damage_box(bbox)
+
+    def queue_damage(self):
+        # Returns whether any redraw was queued.
+        damage = self.damage
+        queued = damage.full or bool(damage.boxes)
+        if damage.full or len(damage.boxes) > self.MAX_DAMAGE_BOXES:
+            self.drawing_area.queue_draw()
+
+        elif damage.boxes:
+            pad = self.DAMAGE_PAD
+            ox, oy = self.current.origin
+            for x0, y0, x1, y1 in damage.boxes:
+                x = int(math.floor(x0 - ox - pad))
+                y = int(math.floor(y0 - oy - pad))
+                self.drawing_area.queue_draw_area(
+                    x, y, int(math.ceil(x1 - ox + pad)) - x,
+                    int(math.ceil(y1 - oy + pad)) - y)
+            # Frame statistics change with every drawn frame.
+            self.drawing_area.queue_draw_area(*self.get_metainfo_area())
+
+        damage.full = False
+        damage.boxes = []
+        return queued
+
     def handle_draw_event(self, widget, ctx):
+        frame_start = time.perf_counter()
+        measure = self.profiler.measure
 
         orig_ctx = ctx
         a = widget.get_allocation()
         surface = self.get_cached_image_surface(a.width, a.height)
         ctx = cairo.Context(surface)
 
+        # Gtk clips drawing to the damaged part of the window. The rest of
+        # the offscreen surface still holds the previous frame, so it's left
+        # as it is.
+        x0, y0, x1, y1 = orig_ctx.clip_extents()
+        try:
+            rectangles = orig_ctx.copy_clip_rectangle_list()
+        except cairo.Error:
+            rectangles = [(x0, y0, x1 - x0, y1 - y0)]
+        for rectangle in rectangles:
+            ctx.rectangle(*rectangle)
+        ctx.clip()
+
         self.update_fps_counter()
 
-        self.draw_canvas(widget.get_allocation(), ctx)
+        with measure('canvas'):
+            self.scene.draw_canvas(ctx, self.current.origin)
 
         ctx.save()
         ctx.translate(- self.current.origin.x, - self.current.origin.y)
 
-        for wire in self.wires:
-            wire.draw(ctx)
+        # Only things intersecting the redrawn part of the canvas are drawn.
+        viewport = (self.current.origin.x + x0, self.current.origin.y + y0,
+                    self.current.origin.x + x1, self.current.origin.y + y1)
+
+        with measure('wires'):
+            wires_drawn = self.scene.draw_wires(ctx, viewport)
 
         if self.state == self.State.CREATING_WIRE and \
            self.wire_end_pos is not None:
             Wire.draw_wire(ctx, self.wire_start.get_coords(),
                            self.wire_end_pos)
 
-        for node in self.nodes:
-            node.draw_shadow(ctx)
-
-        for node in self.nodes:
-            node.draw(ctx,
-                      highlighted_terminal=self.current.highlighted_terminal)
+        # Nodes show results of the latest complete step, which may be
+        # going on right now.
+        contents = self.evaluator.snapshot.contents
+        layer = self.scene.frozen_layer
+        with measure('frozen'):
+            self.scene.draw_frozen(ctx, self.get_viewport(), viewport,
+                                   contents)
+
+        # A frozen node with a highlighted terminal is drawn once more, over
+        # its copy in the frozen layer.
+        highlighted_terminal = self.current.highlighted_terminal
+        visible_nodes = self.scene.get_visible_nodes(viewport)
+        live_nodes = [node for node in visible_nodes if not node.frozen]
+        with measure('shadows'):
+            self.scene.draw_shadows(ctx, live_nodes)
+        if highlighted_terminal is not None and \
+           highlighted_terminal.node.frozen:
+            live_nodes.append(highlighted_terminal.node)
+
+        with measure('nodes'):
+            self.scene.draw_nodes(ctx, live_nodes, contents,
+                                  highlighted_terminal=highlighted_terminal)
 
         ctx.restore()
 
-        self.draw_metainfo(ctx)
+        self.culling.nodes_drawn = len(visible_nodes)
+        self.culling.nodes_culled = len(self.nodes) - len(visible_nodes)
+        self.culling.wires_drawn = wires_drawn + layer.n_wires
+        self.culling.wires_culled = len(self.wires) - self.culling.wires_drawn
+        self.culling.frozen_nodes = len(layer.contents)
+        self.culling.frozen_wires = layer.n_wires
 
-        orig_ctx.set_source_surface(surface, 0, 0)
-        orig_ctx.paint()
+        with measure('metainfo'):
+            self.draw_metainfo(ctx)
 
-    def calculate(self):
-        for wire in self.wires:
-            value = wire.start.node.get_output(wire.start.idx)
-            wire.end.node.set_input(wire.end.idx, value)
+        with measure('blit'):
+            orig_ctx.set_source_surface(surface, 0, 0)
+            orig_ctx.paint()
 
-        for node in self.nodes:
-            node.reset_outputs()
-            node.calculate()
-            node.reset_inputs()
+        self.profiler.record('frame', time.perf_counter() - frame_start)
+
+    def calculate(self):
+        # Runs on the evaluator thread.
+        with self.profiler.measure('calculate'):
+            self.scheduler.calculate(self.nodes, self.wires)
+
+    def take_snapshot(self):
+        # Runs on the evaluator thread, or with the evaluator lock held.
+        with self.profiler.measure('snapshot'):
+            return {node: node.get_contents() for node in self.nodes}
+
+    def toggle_propagation(self):
+        with self.evaluator.lock:
+            if self.scheduler.mode == engine.Scheduler.PROPAGATE:
+                self.scheduler.set_mode(engine.Scheduler.ONE_HOP)
+                print('one hop per step')
+            else:
+                self.scheduler.set_mode(engine.Scheduler.PROPAGATE)
+                print('propagating through acyclic regions')
+
+    def toggle_compiled(self):
+        with self.evaluator.lock:
+            self.scheduler.set_compiled(not self.scheduler.compiled)
+        print('compiled evaluation {}'.format(
+              'on' if self.scheduler.compiled else 'off'))
+
+    def toggle_incremental(self):
+        with self.evaluator.lock:
+            self.scheduler.set_incremental(not self.scheduler.incremental)
+        print('incremental recalculation {}'.format(
+              'on' if self.scheduler.incremental else 'off'))
+
+    def toggle_damage_tracking(self):
+        self.damage_tracking = not self.damage_tracking
+        self.damage_all()
+        print('redrawing {}'.format(
+              'damaged areas only' if self.damage_tracking else 'every frame'))
+
+    def toggle_animation(self):
+        self.animate = not self.animate
+        self.damage_all()
+        print('animation {}'.format('on' if self.animate else 'off'))
+
+    def toggle_catch_up_policy(self):
+        policies = BeatClock.POLICIES
+        policy = policies[(policies.index(self.clock.policy) + 1) %
+                          len(policies)]
+        self.clock.set_policy(policy)
+        self.damage_all()
+        print('missed beats: {}'.format(policy))
 
     def handle_tick(self):
-        self.phase = time.time() * self.bpm / 60.0
-        self.drawing_area.queue_draw()
-        if self.phase > self.next_step:
-            self.next_step = self.next_step + 1
-            self.calculate()
+        self.phase = self.clock.get_phase()
+        self.poll_jobs()
+        if not self.damage_tracking:
+            self.drawing_area.queue_draw()
+
+        step = self.evaluator.snapshot.step
+        stepped = step != self.drawn_step
+        self.drawn_step = step
+        if self.damage_tracking:
+            self.collect_damage(stepped)
+            queued = self.queue_damage()
+            if self.job is not None or self.loader is not None:
+                self.drawing_area.queue_draw_area(*self.get_metainfo_area())
+                queued = True
+            # An idle canvas isn't redrawn at all, and such gaps are not
+            # dropped frames.
+            if not queued:
+                self.frame_counter.pause()
 
         return True
 
+    def handle_destroy(self, widget):
+        self.evaluator.stop()
+        # Let a save in progress finish, rather than lose the file.
+        if self.job is not None:
+            self.job.wait()
+        Gtk.main_quit()
+
     def handle_mouse_move_event(self, widget, event):
         diff = Point(event.x - self.current.pos.x,
                      event.y - self.current.pos.y)
         self.current.pos = Point(event.x, event.y)
 
         if self.state == self.State.MOVING_NODE:
-            self.moving_node.x = event.x - self.moving_node_offset.x
-            self.moving_node.y = event.y - self.moving_node_offset.y
+            self.moving_node.move(event.x - self.moving_node_offset.x,
+                                  event.y - self.moving_node_offset.y)
 
         elif self.state == self.State.CREATING_WIRE:
             self.current.pos = Point(event.x, event.y)
@@ -976,25 +1628,40 @@ class Showtime(Gtk.Window):
                 self.current.origin.x - diff.x * self.CANVAS_MOVE_SPEED,
                 self.current.origin.y - diff.y * self.CANVAS_MOVE_SPEED)
 
+        if self.state != self.State.DEFAULT:
+            self.damage_all()
+
+        old_highlighted = self.current.highlighted_terminal
         self.current.highlighted_terminal = None
-        for node in reversed(self.nodes):
-            res = node.get_intersections(self.current.origin.x + event.x,
-                                         self.current.origin.y + event.y)
+        x = self.current.origin.x + event.x
+        y = self.current.origin.y + event.y
+        for node in self.scene.query_point(x, y):
+            res = node.get_intersections(x, y)
             if not res:
                 continue
 
             if res.type == Node.TERMINAL:
                 self.current.highlighted_terminal = res.value
+            break
+
+        new_highlighted = self.current.highlighted_terminal
+        if old_highlighted is None or new_highlighted is None or \
+           not old_highlighted == new_highlighted:
+            for t in (old_highlighted, new_highlighted):
+                if t is not None:
+                    self.damage_box(t.node.get_bounding_box())
 
     def _get_element_at(self, pos):
-        for node in reversed(self.nodes):
-            res = node.get_intersections(pos.x + self.current.origin.x,
-                                         pos.y + self.current.origin.y)
+        x = pos.x + self.current.origin.x
+        y = pos.y + self.current.origin.y
+        for node in self.scene.query_point(x, y):
+            res = node.get_intersections(x, y)
             if res:
                 return res
         return None
 
     def handle_mouse_press_event(self, widget, event):
+        self.damage_all()
         res = self._get_element_at(Point(event.x, event.y))
         self.current.element = res
 
@@ -1018,8 +1685,9 @@ class Showtime(Gtk.Window):
             if res is None:
                 self.menus.blank_space.popup_at_pointer(event)
             elif res.type == Node.BODY:
-                if res.value.menu is not None:
-                    res.value.menu.popup_at_pointer(event)
+                menu = res.value.get_menu()
+                if menu is not None:
+                    menu.popup_at_pointer(event)
             elif res.type == Node.TERMINAL:
                 self.menus.terminal.popup_at_pointer(event)
 
@@ -1032,14 +1700,24 @@ class Showtime(Gtk.Window):
                         self.add_wire(self.wire_start, res.value)
 
         self.state = self.State.DEFAULT
+        self.damage_all()
 
     def handle_key_press_event(self, widget, event):
         KEY_r = 27
         KEY_t = 28
+        KEY_u = 30
+        KEY_i = 31
+        KEY_p = 33
         KEY_a = 38
+        KEY_s = 39
         KEY_d = 40
         KEY_f = 41
+        KEY_c = 54
         KEY_v = 55
+        KEY_b = 56
+        KEY_n = 57
+        KEY_F3 = 69
+        KEY_F4 = 70
         KEY_F6 = 72
         KEY_F9 = 75
 
@@ -1052,7 +1730,8 @@ class Showtime(Gtk.Window):
         if event.hardware_keycode == KEY_f or event.hardware_keycode == KEY_t:
             res = self._get_element_at(self.current.pos)
             if res is not None and res.type == Node.BODY:
-                res.value.freeze(event.hardware_keycode == KEY_f)
+                res.value.edit(res.value.freeze,
+                               event.hardware_keycode == KEY_f)
 
         if event.hardware_keycode == KEY_d:
             res = self._get_element_at(self.current.pos)
@@ -1065,76 +1744,153 @@ class Showtime(Gtk.Window):
                type(res.value) == RegisterNode:
                 res.value.invoke_ask_value_dialog()
 
+        if event.hardware_keycode == KEY_c:
+            self.toggle_compiled()
+
+        if event.hardware_keycode == KEY_i:
+            self.toggle_incremental()
+
+        if event.hardware_keycode == KEY_p:
+            self.toggle_propagation()
+
+        if event.hardware_keycode == KEY_u:
+            self.toggle_damage_tracking()
+
+        if event.hardware_keycode == KEY_n:
+            self.toggle_animation()
+
+        if event.hardware_keycode == KEY_s:
+            self.toggle_autosave()
+
+        if event.hardware_keycode == KEY_b:
+            self.toggle_catch_up_policy()
+
+        if event.hardware_keycode == KEY_F3:
+            self.show_profile = not self.show_profile
+            self.damage_all()
+
+        if event.hardware_keycode == KEY_F4:
+            self.dump_profile()
+
         if event.hardware_keycode == KEY_F9:
             self.save_state()
 
         if event.hardware_keycode == KEY_F6:
             self.restore_state()
 
-    def save_state(self):
-        text = ask_string(title='Save State', description='---', old_text='')
-        if text is None:
-            return
+    def is_busy(self):
+        if self.job is None and self.loader is None:
+            return False
+        print('busy {}, try again later'.format(self.get_job_status()))
+        return True
 
-        def serialize_nodes():
-            res = []
-            for node in self.nodes:
-                node_descr = {'type': type(node).__name__,
-                              'value': node.value,
-                              'frozen': node.frozen,
-                              'operation': node.operation,
-                              'x': node.x,
-                              'y': node.y}
-                res.append(node_descr)
-            return res
-
-        def serialize_terminal(t):
-            return {'node': self.nodes.index(t.node),
-                    'terminal_type': t.terminal_type,
-                    'idx': t.idx}
-
-        def serialize_wires():
-            res = []
-            for wire in self.wires:
-                wire_descr = {'start': serialize_terminal(wire.start),
-                              'end': serialize_terminal(wire.end)}
-                res.append(wire_descr)
-            return res
+    def get_job_status(self):
+        if self.loader is not None:
+            return 'loading {}: {:.0%}'.format(self.state_filename,
+                                               self.loader.progress)
+        if self.job is not None:
+            return '{}: {:.0%}'.format(self.job.name, self.job.progress)
+        return ''
+
+    def poll_jobs(self):
+        # Picks up finished jobs, continues building a loaded schema, and
+        # starts autosaves that are due.
+        job = self.job
+        if job is not None and job.done:
+            self.job = None
+            if job.error is not None:
+                print('{} failed: {}'.format(job.name, job.error))
+            elif job.on_done is not None:
+                job.on_done(job.result)
+
+        if self.loader is not None:
+            deadline = time.perf_counter() + self.LOAD_TIME_BUDGET
+            with self.profiler.measure('load'):
+                for progress in self.loader.steps:
+                    self.loader.progress = progress
+                    if time.perf_counter() > deadline:
+                        break
+                else:
+                    self.loader = None
+
+        if self.autosave and self.job is None and self.loader is None and \
+           time.monotonic() >= self.next_autosave:
+            self.next_autosave = time.monotonic() + self.AUTOSAVE_INTERVAL
+            self.start_save(self.AUTOSAVE_FILENAME)
+
+    def toggle_autosave(self):
+        self.autosave = not self.autosave
+        self.next_autosave = time.monotonic() + self.AUTOSAVE_INTERVAL
+        print('autosave to {} every {} s {}'.format(
+              self.AUTOSAVE_FILENAME, self.AUTOSAVE_INTERVAL,
+              'on' if self.autosave else 'off'))
+
+    def start_save(self, filename):
+        # The schema is captured by the evaluator right after its next step,
+        # so the copy is consistent. Only a quick copy is taken there, with
+        # the lock held; records are made of it and written out by another
+        # job while the schema keeps running.
+        self.job = Job('waiting for a step to save {}'.format(filename),
+                       lambda progress: schema.capture(self.nodes,
+                                                       self.wires),
+                       on_done=lambda captured: self._write_state(
+                           filename, captured),
+                       thread=False)
+        self.evaluator.request(self.job)
+
+    def _write_state(self, filename, captured):
+        def save(progress):
+            nodes, wires = schema.make_records(*captured)
+            schema.save(filename, nodes, wires, progress)
+            print('state saved to {}, {} node{}, {} wire{}'.format(
+                  filename, len(nodes), 's' if len(nodes) > 0 else '',
+                  len(wires), 's' if len(wires) > 0 else ''))
+
+        self.job = Job('saving {}'.format(filename), save)
 
-        state = {'nodes': serialize_nodes(),
-                 'wires': serialize_wires()}
+    def save_state(self):
+        # Files with names ending with .shtk are saved in binary format.
+        if self.is_busy():
+            return
 
-        with open('state.json', 'w') as f:
-            f.write(json.dumps(state, indent=4))
+        text = ask_string(title='Save State', description='File name:',
+                          old_text=self.state_filename)
+        if not text:
+            return
 
-        print('state saved, {} node{}, {} wire{}'.format(
-              len(self.nodes), 's' if len(self.nodes) > 0 else '',
-              len(self.wires), 's' if len(self.wires) > 0 else ''))
+        self.state_filename = text
+        self.start_save(text)
 
     def restore_state(self):
-        self.current.origin = Point(0, 0)
-        self.nodes = []
-        self.wires = []
-
-        with open('state.json') as f:
-            state = json.loads(f.read())
-
-        for node in state['nodes']:
-            if not node['type'].endswith('Node'):
-                continue
+        # The file is parsed on a worker thread. Nodes are then built aside,
+        # and replace the current schema all at once.
+        if self.is_busy():
+            return
 
-            node_class = globals()[node['type']]
-            obj = self.add_node_at(node_class, node['x'], node['y'])
-            obj.value = node['value']
-            obj.frozen = node['frozen']
-            obj.operation = node['operation']
-
-        for wire in state['wires']:
-            def get_terminal(s):
-                return self.nodes[s['node']].get_terminal(s['terminal_type'],
-                                                          s['idx'])
-            self.add_wire(get_terminal(wire['start']),
-                          get_terminal(wire['end']))
+        filename = self.state_filename
+        self.job = Job('parsing {}'.format(filename),
+                       lambda progress: schema.load(filename),
+                       on_done=self._start_loading)
+
+    def _start_loading(self, records):
+        self.loader = Obj(steps=self._load_graph(*records), progress=0.0)
+
+    def _load_graph(self, node_records, wire_records):
+        # Builds the new scene aside, yielding the fraction of work done, and
+        # then swaps it in at once.
+        scene = Scene()
+        yield from scene.load(node_records, wire_records, self._create_node,
+                              self._phase_func)
+
+        with self.evaluator.lock:
+            self.scene = scene
+            self.scheduler.invalidate()
+            self.evaluator.refresh()
+        self.current.origin = Point(0, 0)
+        self.current.highlighted_terminal = None
+        self.current.element = None
+        self.state = self.State.DEFAULT
+        self.damage_all()
 
         print('state restored, {} node{}, {} wire{}'.format(
               len(self.nodes), 's' if len(self.nodes) > 0 else '',
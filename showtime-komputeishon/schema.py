@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Reading and writing schemas, as JSON or in a compact binary format.
+#
+# Binary schema layout, all numbers little endian:
+#
+#   header   magic 'SHTK', u16 version, u16 flags (zero), u32 node count,
+#            u32 wire count
+#   nodes    fixed size records: u8 type, u8 frozen, u8 operation,
+#            u8 value tag, f64 x, f64 y, i64 value, i64 value
+#   wires    fixed size records: u32 start node, u16 start output,
+#            u32 end node, u16 end input
+#   extras   values that don't fit into a node record, as JSON text
+#
+# Both record arrays have a fixed stride, so a file can be written record
+# by record and read in bulk straight from a memory mapping.
+
+from collections import namedtuple
+import argparse
+import io
+import json
+import mmap
+import operator
+import os
+import struct
+import sys
+
+import engine
+
+NodeRecord = namedtuple('NodeRecord', ['type', 'value', 'frozen', 'operation',
+                                       'x', 'y'])
+# Wires always go from an output to an input. Nodes are referred to by
+# their index in the schema.
+WireRecord = namedtuple('WireRecord', ['start_node', 'start_idx', 'end_node',
+                                       'end_idx'])
+
+# Fields of a node record other than the type, in the record order.
+NODE_STATE = operator.attrgetter('value', 'frozen', 'operation', 'x', 'y')
+
+MAGIC = b'SHTK'
+VERSION = 1
+BINARY_SUFFIX = '.shtk'
+
+HEADER = struct.Struct('<4sHHII')
+NODE = struct.Struct('<BBBBddqq')
+WIRE = struct.Struct('<IHIH')
+
+# Codes of node types and operations, in version 1 of the format.
+NODE_TYPES = ('RegisterNode', 'ArithmeticNode', 'PointNode', 'GraphNode',
+              'ConditionalNode')
+OPERATIONS = ('', '+', '×', '-', '/', '%', '>', '<', '=', '≠', '≥', '≤')
+
+# Value tags.
+NONE = 0
+INT = 1
+POINT = 2
+JSON = 3  # Anything else, stored among the extras.
+
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+CHUNK_SIZE = 4096  # records
+
+
+def capture(nodes, wires):
+    # Copy of the live schema, quick enough to be taken between two steps.
+    # Types of nodes and ends of wires never change, so only node fields
+    # are copied, and records are made of the copy later by make_records().
+    nodes = list(nodes)
+    return nodes, list(wires), list(map(NODE_STATE, nodes))
+
+
+def make_records(nodes, wires, states):
+    node_idx = {node: k for k, node in enumerate(nodes)}
+    node_records = [NodeRecord(type(node).__name__, value, frozen, operation,
+                               x, y)
+                    for node, (value, frozen, operation, x, y)
+                    in zip(nodes, states)]
+    wire_records = [WireRecord(node_idx[wire.start.node], wire.start.idx,
+                               node_idx[wire.end.node], wire.end.idx)
+                    for wire in wires]
+    return node_records, wire_records
+
+
+def snapshot(nodes, wires):
+    # Records describing live nodes and wires. Node values are immutable,
+    # so records can be written out while the nodes keep changing.
+    return make_records(*capture(nodes, wires))
+
+
+def write_json(filename, nodes, wires, progress=None):
+    state = {'nodes': [{'type': n.type,
+                        'value': n.value,
+                        'frozen': n.frozen,
+                        'operation': n.operation,
+                        'x': n.x,
+                        'y': n.y} for n in nodes],
+             'wires': [{'start': {'node': w.start_node,
+                                  'terminal_type': engine.Node.OUTPUT,
+                                  'idx': w.start_idx},
+                        'end': {'node': w.end_node,
+                                'terminal_type': engine.Node.INPUT,
+                                'idx': w.end_idx}} for w in wires]}
+
+    with open(filename, 'w') as f:
+        f.write(json.dumps(state, indent=4))
+    if progress is not None:
+        progress(1.0)
+
+
+def read_json(filename):
+    with open(filename) as f:
+        state = json.loads(f.read())
+
+    nodes = [NodeRecord(n['type'], n['value'], n['frozen'], n['operation'],
+                        n['x'], n['y']) for n in state['nodes']]
+
+    wires = []
+    for wire in state['wires']:
+        start, end = wire['start'], wire['end']
+        wire_ends = (start['terminal_type'], end['terminal_type'])
+        if wire_ends == (engine.Node.INPUT, engine.Node.OUTPUT):
+            start, end = end, start
+        elif wire_ends != (engine.Node.OUTPUT, engine.Node.INPUT):
+            continue
+        # Same as engine.orient_wire(), a node can't be wired to itself.
+        if start['node'] == end['node']:
+            continue
+        wires.append(WireRecord(start['node'], start['idx'],
+                                end['node'], end['idx']))
+
+    return nodes, wires
+
+
+def _encode_value(value, extras):
+    # Returns the tag and two numbers for a node record.
+    if value is None:
+        return NONE, 0, 0
+    if type(value) == int and INT64_MIN <= value <= INT64_MAX:
+        return INT, value, 0
+    if type(value) == engine.Point and \
+       type(value.x) == int and INT64_MIN <= value.x <= INT64_MAX and \
+       type(value.y) == int and INT64_MIN <= value.y <= INT64_MAX:
+        return POINT, value.x, value.y
+
+    text = json.dumps(value).encode('utf-8')
+    offset = extras.tell()
+    extras.write(text)
+    return JSON, offset, len(text)
+
+
+def _decode_value(tag, a, b, extras):
+    if tag == INT:
+        return a
+    if tag == POINT:
+        return engine.Point(a, b)
+    if tag == JSON:
+        return json.loads(extras[a:a + b].decode('utf-8'))
+    return None
+
+
+def _code(table, name, what):
+    try:
+        return table.index(name)
+    except ValueError:
+        raise ValueError("can't store {} {!r}".format(what, name))
+
+
+def write_binary(filename, nodes, wires, progress=None):
+    # Records are packed and written in chunks, so memory use doesn't depend
+    # on the schema size, apart from the rare values kept as extras.
+    # `progress` is called with the fraction of records written after every
+    # chunk.
+    extras = io.BytesIO()
+    total = max(len(nodes) + len(wires), 1)
+    written = 0
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(nodes), len(wires)))
+
+        chunk = []
+        for n in nodes:
+            tag, a, b = _encode_value(n.value, extras)
+            chunk.append(NODE.pack(_code(NODE_TYPES, n.type, 'node type'),
+                                   bool(n.frozen),
+                                   _code(OPERATIONS, n.operation, 'operation'),
+                                   tag, n.x, n.y, a, b))
+            if len(chunk) == CHUNK_SIZE:
+                f.write(b''.join(chunk))
+                written += len(chunk)
+                chunk = []
+                if progress is not None:
+                    progress(written / total)
+        f.write(b''.join(chunk))
+        written += len(chunk)
+
+        chunk = []
+        for w in wires:
+            chunk.append(WIRE.pack(w.start_node, w.start_idx, w.end_node,
+                                   w.end_idx))
+            if len(chunk) == CHUNK_SIZE:
+                f.write(b''.join(chunk))
+                written += len(chunk)
+                chunk = []
+                if progress is not None:
+                    progress(written / total)
+        f.write(b''.join(chunk))
+
+        f.write(extras.getvalue())
+    if progress is not None:
+        progress(1.0)
+
+
+def read_binary(filename):
+    with open(filename, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, \
+            memoryview(m) as view:
+        if len(view) < HEADER.size:
+            raise ValueError('{}: truncated schema'.format(filename))
+
+        magic, version, _, n_nodes, n_wires = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError('{}: not a binary schema'.format(filename))
+        if version != VERSION:
+            raise ValueError('{}: unsupported schema version {}'.format(
+                             filename, version))
+
+        nodes_start = HEADER.size
+        wires_start = nodes_start + n_nodes * NODE.size
+        extras_start = wires_start + n_wires * WIRE.size
+        if len(view) < extras_start:
+            raise ValueError('{}: truncated schema'.format(filename))
+
+        extras = bytes(view[extras_start:])
+        with view[nodes_start:wires_start] as records:
+            nodes = [NodeRecord(NODE_TYPES[t],
+                                _decode_value(tag, a, b, extras),
+                                bool(frozen), OPERATIONS[op], x, y)
+                     for t, frozen, op, tag, x, y, a, b in
+                     NODE.iter_unpack(records)]
+        with view[wires_start:extras_start] as records:
+            wires = [WireRecord(*w) for w in WIRE.iter_unpack(records)]
+
+    return nodes, wires
+
+
+def is_binary(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load(filename):
+    # Returns lists of node and wire records, from a file in either format.
+    if is_binary(filename):
+        return read_binary(filename)
+    return read_json(filename)
+
+
+def save(filename, nodes, wires, progress=None):
+    # Format is chosen by the file name. The schema is written next to the
+    # old file and then renamed over it, so an interrupted save never leaves
+    # a truncated file behind.
+    tmp_filename = filename + '.tmp'
+    if filename.endswith(BINARY_SUFFIX):
+        write_binary(tmp_filename, nodes, wires, progress)
+    else:
+        write_json(tmp_filename, nodes, wires, progress)
+    os.replace(tmp_filename, filename)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Convert Showtime schemas between JSON and binary '
+                    'formats. Output format is binary if the file name '
+                    'ends with {}, JSON otherwise.'.format(BINARY_SUFFIX))
+    parser.add_argument('input', help='schema in either format')
+    parser.add_argument('output', help='converted schema')
+    args = parser.parse_args(argv)
+
+    nodes, wires = load(args.input)
+    save(args.output, nodes, wires)
+    print('{} node{}, {} wire{} converted'.format(
+          len(nodes), 's' if len(nodes) > 0 else '',
+          len(wires), 's' if len(wires) > 0 else ''), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
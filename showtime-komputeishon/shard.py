@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Evaluation of a large schema split between several worker processes.
+#
+# Nodes are partitioned into shards, each owned by a worker. Outputs that
+# feed nodes in other shards are exchanged through shared memory once per
+# step. Exchange uses two buffers: on step s workers read values written on
+# step s - 1 from one of them, and write their own into the other. This is
+# exactly what the one hop per step evaluation does, so results match
+# the single process engine. Only that scheduling mode is supported.
+
+from collections import deque
+from multiprocessing import shared_memory
+import multiprocessing
+import traceback
+
+import engine
+
+# Exchanged values are encoded as three int64 numbers: a tag and two
+# components.
+NONE = 0
+INT = 1
+POINT = 2
+SLOT_SIZE = 3
+
+
+def partition(nodes, wires, n_shards):
+    # Lays out connected components one after another, each in breadth
+    # first order, and cuts the result into equal parts. Small components
+    # end up in a single shard, while large ones are cut along BFS fronts,
+    # which keeps the number of wires between shards low.
+    neighbours = {node: [] for node in nodes}
+    for wire in wires:
+        neighbours[wire.start.node].append(wire.end.node)
+        neighbours[wire.end.node].append(wire.start.node)
+
+    order = []
+    seen = set()
+    for root in nodes:
+        if root in seen:
+            continue
+        seen.add(root)
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for n in neighbours[node]:
+                if n not in seen:
+                    seen.add(n)
+                    queue.append(n)
+
+    shard_of = {}
+    for k, node in enumerate(order):
+        shard_of[node] = k * n_shards // max(len(order), 1)
+
+    # Keep the original node order within each shard.
+    shards = [[] for _ in range(n_shards)]
+    for node in nodes:
+        shards[shard_of[node]].append(node)
+
+    return shards
+
+
+def _encode(buf, pos, value):
+    if value is None:
+        buf[pos] = NONE
+    elif type(value) == int:
+        buf[pos] = INT
+        buf[pos + 1] = value
+    elif type(value) == engine.Point and type(value.x) == int and \
+            type(value.y) == int:
+        buf[pos] = POINT
+        buf[pos + 1] = value.x
+        buf[pos + 2] = value.y
+    else:
+        raise TypeError("can't pass {!r} between shards".format(value))
+
+
+def _decode(buf, pos):
+    tag = buf[pos]
+    if tag == INT:
+        return buf[pos + 1]
+    if tag == POINT:
+        return engine.Point(buf[pos + 1], buf[pos + 2])
+    return None
+
+
+def _buffer_size(n_slots):
+    # Two sets of slots, of int64 numbers. Some systems round shared memory
+    # size up, so views are always cut to this size.
+    return max(1, 2 * n_slots * SLOT_SIZE) * 8
+
+
+def _worker(conn, nodes, wires, imports, exports, shm_name, n_slots,
+            barrier):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buf = shm.buf[:_buffer_size(n_slots)].cast('q')
+    scheduler = engine.Scheduler()
+    try:
+        while True:
+            command = conn.recv()
+            if command[0] == 'run':
+                _, first_step, n_steps = command
+                for step in range(first_step, first_step + n_steps):
+                    read_base = (step % 2) * n_slots * SLOT_SIZE
+                    write_base = ((step + 1) % 2) * n_slots * SLOT_SIZE
+
+                    for node, idx, slot in imports:
+                        node.set_input(idx, _decode(buf, read_base +
+                                                    slot * SLOT_SIZE))
+
+                    scheduler.calculate(nodes, wires)
+
+                    for node, idx, slot in exports:
+                        _encode(buf, write_base + slot * SLOT_SIZE,
+                                node.get_output(idx))
+
+                    barrier.wait()
+                conn.send(('done', None))
+
+            elif command[0] == 'collect':
+                conn.send(('state', [
+                    (node.value, list(node.output_values),
+                     getattr(node, 'plotted', None)) for node in nodes]))
+
+            elif command[0] == 'stop':
+                break
+
+    except Exception:
+        # Don't leave other workers waiting on the barrier forever.
+        barrier.abort()
+        conn.send(('error', traceback.format_exc()))
+
+    finally:
+        del buf
+        shm.close()
+
+
+class ShardedEngine(object):
+    def __init__(self, nodes, wires, n_workers):
+        # Workers get copies of the nodes, so the schema must not be edited
+        # while the sharded engine is alive. Call collect() to bring results
+        # back into the nodes.
+        self.nodes = nodes
+        self.steps = 0
+        self.shards = partition(nodes, wires, n_workers)
+        shard_of = {node: k for k, shard in enumerate(self.shards)
+                    for node in shard}
+
+        local_wires = [[] for _ in self.shards]
+        imports = [[] for _ in self.shards]
+        exports = [[] for _ in self.shards]
+        slot_of = {}
+        for wire in wires:
+            src = (wire.start.node, wire.start.idx)
+            src_shard = shard_of[wire.start.node]
+            dst_shard = shard_of[wire.end.node]
+            if src_shard == dst_shard:
+                local_wires[dst_shard].append(wire)
+                continue
+
+            if src not in slot_of:
+                slot_of[src] = len(slot_of)
+                exports[src_shard].append(src + (slot_of[src],))
+            imports[dst_shard].append((wire.end.node, wire.end.idx,
+                                       slot_of[src]))
+
+        self.n_boundary_wires = sum(len(i) for i in imports)
+        n_slots = len(slot_of)
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=_buffer_size(n_slots))
+        buf = self.shm.buf[:_buffer_size(n_slots)].cast('q')
+        for (node, idx), slot in slot_of.items():
+            _encode(buf, slot * SLOT_SIZE, node.get_output(idx))
+        del buf
+
+        # Fork, so that nodes are inherited instead of being pickled.
+        ctx = multiprocessing.get_context('fork')
+        barrier = ctx.Barrier(len(self.shards))
+        self.workers = []
+        for k, shard in enumerate(self.shards):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker,
+                args=(child_conn, shard, local_wires[k], imports[k],
+                      exports[k], self.shm.name, n_slots, barrier),
+                daemon=True)
+            process.start()
+            self.workers.append((process, parent_conn))
+
+    def _wait(self, expected):
+        results = []
+        errors = []
+        for _, conn in self.workers:
+            reply, payload = conn.recv()
+            if reply == 'error':
+                errors.append(payload)
+            elif reply == expected:
+                results.append(payload)
+        if errors:
+            raise Exception('worker failed:\n' + errors[0])
+        return results
+
+    def run(self, n_steps):
+        for _, conn in self.workers:
+            conn.send(('run', self.steps, n_steps))
+        self._wait('done')
+        self.steps += n_steps
+
+    def collect(self):
+        # Copies node state from workers back into the original nodes.
+        for _, conn in self.workers:
+            conn.send(('collect',))
+        for shard, state in zip(self.shards, self._wait('state')):
+            for node, (value, outputs, plotted) in zip(shard, state):
+                node.value = value
+                node.output_values = outputs
+                if plotted is not None:
+                    node.set_plotted(plotted)
+
+    def close(self):
+        for process, conn in self.workers:
+            if process.is_alive():
+                conn.send(('stop',))
+            process.join()
+        self.workers = []
+        self.shm.close()
+        self.shm.unlink()
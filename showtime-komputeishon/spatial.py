@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Uniform grid index of bounding boxes, for finding canvas items near a
+# point without looking at every one of them.
+
+import math
+
+
+def boxes_intersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class GridIndex(object):
+    def __init__(self, cell_size=256):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.item_cells = {}
+        # Items remember the order they were added in, which is also the
+        # order they are drawn in.
+        self.serials = {}
+        self.next_serial = 0
+
+    def _cells(self, bbox):
+        x0, y0, x1, y1 = bbox
+        cs = self.cell_size
+        return [(cx, cy)
+                for cx in range(math.floor(x0 / cs), math.floor(x1 / cs) + 1)
+                for cy in range(math.floor(y0 / cs), math.floor(y1 / cs) + 1)]
+
+    def insert(self, item, bbox):
+        if item in self.serials:
+            self.update(item, bbox)
+            return
+
+        self.serials[item] = self.next_serial
+        self.next_serial += 1
+        keys = self._cells(bbox)
+        for key in keys:
+            self.cells.setdefault(key, set()).add(item)
+        self.item_cells[item] = keys
+
+    def update(self, item, bbox):
+        keys = self._cells(bbox)
+        old_keys = self.item_cells[item]
+        if keys == old_keys:
+            return
+
+        for key in old_keys:
+            self._discard(key, item)
+        for key in keys:
+            self.cells.setdefault(key, set()).add(item)
+        self.item_cells[item] = keys
+
+    def _discard(self, key, item):
+        cell = self.cells[key]
+        cell.discard(item)
+        if not cell:
+            del self.cells[key]
+
+    def remove(self, item):
+        if item not in self.serials:
+            return
+
+        for key in self.item_cells.pop(item):
+            self._discard(key, item)
+        del self.serials[item]
+
+    def clear(self):
+        self.cells = {}
+        self.item_cells = {}
+        self.serials = {}
+
+    def __len__(self):
+        return len(self.serials)
+
+    def query_point(self, x, y):
+        # Items whose bounding box may contain the point, topmost first.
+        cs = self.cell_size
+        cell = self.cells.get((math.floor(x / cs), math.floor(y / cs)), ())
+        return sorted(cell, key=self.serials.__getitem__, reverse=True)
+
+    def query_rect(self, bbox):
+        # Items whose bounding box may intersect the given one, in the order
+        # they were added.
+        items = set()
+        for key in self._cells(bbox):
+            items.update(self.cells.get(key, ()))
+        return sorted(items, key=self.serials.__getitem__)
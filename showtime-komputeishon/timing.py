@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019  Rinat Ibragimov
+# SPDX-License-Identifier: MIT
+
+# Frame statistics, per-stage profiling and the beat clock. Nothing here
+# may import Gtk, as bench.py uses the clock on machines without a display.
+
+from array import array
+import csv
+import json
+import math
+import time
+
+
+class RingBuffer(object):
+    # Keeps the last `size` float samples without allocating on append.
+    def __init__(self, size):
+        self.data = array('d', [0.0]) * size
+        self.size = size
+        self.count = 0
+        self.pos = 0
+
+    def append(self, value):
+        self.data[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def values(self):
+        # Samples in the order they were added, oldest first.
+        if self.count < self.size:
+            return self.data[:self.count]
+        return self.data[self.pos:] + self.data[:self.pos]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))
+    return sorted_values[k]
+
+
+def summarize(samples):
+    # Statistics of a sample buffer, in milliseconds.
+    values = sorted(samples.values())
+    return {'count': len(values),
+            'mean': 1000 * sum(values) / max(len(values), 1),
+            'p50': 1000 * percentile(values, 50),
+            'p95': 1000 * percentile(values, 95),
+            'p99': 1000 * percentile(values, 99),
+            'max': 1000 * (values[-1] if values else 0.0)}
+
+
+class Profiler(object):
+    # Durations of named stages over the last `size` frames.
+
+    class Measurement(object):
+        def __init__(self, profiler, name):
+            self.profiler = profiler
+            self.name = name
+
+        def __enter__(self):
+            self.start = time.perf_counter()
+
+        def __exit__(self, *exc):
+            self.profiler.record(self.name, time.perf_counter() - self.start)
+
+    def __init__(self, size=600):
+        self.size = size
+        self.stages = {}
+
+    def measure(self, name):
+        return Profiler.Measurement(self, name)
+
+    def record(self, name, seconds):
+        if name not in self.stages:
+            self.stages[name] = RingBuffer(self.size)
+        self.stages[name].append(seconds)
+
+    def summary(self):
+        # Statistics for every stage, in milliseconds.
+        # Stages may be recorded from other threads.
+        return {name: summarize(samples)
+                for name, samples in list(self.stages.items())}
+
+    def dump_json(self, filename):
+        with open(filename, 'w') as f:
+            f.write(json.dumps({'summary': self.summary(),
+                                'samples': {name: list(samples.values())
+                                            for name, samples in
+                                            list(self.stages.items())}},
+                               indent=4))
+
+    def dump_csv(self, filename):
+        fields = ['stage', 'count', 'mean', 'p50', 'p95', 'p99', 'max']
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for name, stats in self.summary().items():
+                writer.writerow([name] + ['{:.4f}'.format(stats[k])
+                                          if k != 'count' else stats[k]
+                                          for k in fields[1:]])
+
+
+class FrameCounter(object):
+    # Frame rate and frame time statistics over the last `size` frames.
+    # Intervals are also counted in a histogram of fixed-width bins, which
+    # is updated as samples enter and leave the window, so percentiles can
+    # be read every frame without sorting or allocating anything.
+
+    def __init__(self, budget=0.016, size=120, bin_width=0.0005, n_bins=200):
+        self.budget = budget
+        self.intervals = RingBuffer(size)
+        self.bin_width = bin_width
+        self.histogram = array('l', [0]) * n_bins
+        self.total = 0.0
+        self.last_timestamp = None
+        self.dropped = 0
+
+    def _bin(self, interval):
+        return min(int(interval / self.bin_width), len(self.histogram) - 1)
+
+    def tick(self, timestamp):
+        # Call once per frame, with a monotonic timestamp in seconds.
+        last, self.last_timestamp = self.last_timestamp, timestamp
+        if last is None:
+            return
+
+        interval = timestamp - last
+        intervals = self.intervals
+        if len(intervals) == intervals.size:
+            evicted = intervals.data[intervals.pos]
+            self.histogram[self._bin(evicted)] -= 1
+            self.total -= evicted
+        intervals.append(interval)
+        self.histogram[self._bin(interval)] += 1
+        self.total += interval
+
+        # Running sum drifts with rounding errors, recalculate it from time
+        # to time.
+        if intervals.pos == 0:
+            self.total = sum(intervals.data)
+
+        # A frame that took several budgets means some frames were skipped.
+        if interval > 1.5 * self.budget:
+            self.dropped += int(round(interval / self.budget)) - 1
+
+    def pause(self):
+        # Call when no frame is expected, e.g. nothing on screen changed.
+        # The gap until the next frame isn't counted then.
+        self.last_timestamp = None
+
+    def get_fps(self):
+        if len(self.intervals) == 0 or self.total <= 0:
+            return 0.0
+        return len(self.intervals) / self.total
+
+    def get_mean(self):
+        if len(self.intervals) == 0:
+            return 0.0
+        return self.total / len(self.intervals)
+
+    def get_percentile(self, p):
+        # Upper edge of the histogram bin holding the p-th percentile.
+        threshold = p / 100.0 * len(self.intervals)
+        seen = 0
+        for k, n in enumerate(self.histogram):
+            seen += n
+            if n > 0 and seen >= threshold:
+                return (k + 1) * self.bin_width
+        return 0.0
+
+
+class BeatClock(object):
+    # Beats on the monotonic clock. The phase is lined up with the wall
+    # clock once, at creation, so instances on different machines agree on
+    # it, but later wall clock adjustments don't make beats jump.
+    #
+    # poll() tells how many calculation steps are due. When it's called
+    # late, several beats may be due at once, and the policy decides what
+    # to do with them:
+    #   RUN_ALL   a step for every beat, up to MAX_CATCH_UP at once
+    #   COALESCE  a single step for all of them
+    #   DROP      a single step, only if the latest beat is no later than
+    #             DROP_TOLERANCE of a beat; missed beats are skipped
+
+    RUN_ALL = 'all'
+    COALESCE = 'coalesce'
+    DROP = 'drop'
+    POLICIES = (RUN_ALL, COALESCE, DROP)
+
+    MAX_CATCH_UP = 16  # beats
+    DROP_TOLERANCE = 0.25  # of a beat
+
+    def __init__(self, bpm, policy=RUN_ALL, size=600, clock=time.monotonic):
+        self.clock = clock
+        self.offset = time.time() - clock()
+        self.policy = policy
+        self.lateness = RingBuffer(size)
+        self.beats = 0
+        self.steps = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.set_bpm(bpm)
+
+    def set_bpm(self, bpm):
+        self.bpm = bpm
+        self.next_beat = math.floor(self.get_phase()) + 1
+
+    def set_policy(self, policy):
+        self.policy = policy
+
+    def get_phase(self, now=None):
+        if now is None:
+            now = self.clock()
+        return (now + self.offset) * self.bpm / 60.0
+
+    def get_beat_time(self, beat):
+        return beat * 60.0 / self.bpm - self.offset
+
+    def get_time_to_next_beat(self):
+        return max(0.0, self.get_beat_time(self.next_beat) - self.clock())
+
+    def poll(self):
+        now = self.clock()
+        due = math.floor(self.get_phase(now)) + 1 - self.next_beat
+        if due <= 0:
+            return 0
+
+        # Lateness of the oldest due beat is how far the clock lags behind.
+        self.lateness.append(now - self.get_beat_time(self.next_beat))
+        latest = self.next_beat + due - 1
+        self.next_beat += due
+        self.beats += due
+
+        if self.policy == self.RUN_ALL:
+            steps = min(due, self.MAX_CATCH_UP)
+        elif self.policy == self.COALESCE:
+            steps = 1
+            self.coalesced += due - 1
+        else:
+            tolerance = self.DROP_TOLERANCE * 60.0 / self.bpm
+            steps = 1 if now - self.get_beat_time(latest) <= tolerance else 0
+
+        if self.policy != self.COALESCE:
+            self.dropped += due - steps
+        self.steps += steps
+        return steps
+
+    def get_jitter(self):
+        # Lateness statistics, in milliseconds.
+        return summarize(self.lateness)